@@ -0,0 +1,436 @@
+"""Нагрузочный прогон всех ресурсов main_api.py на синтетических данных.
+
+python3 bench_api.py [--rows 1000 100000 1000000] [--requests 30] [--concurrency 1] [--database URL]
+                     [--baseline bench_api_baseline.json] [--save-baseline FILE] [--tolerance 0.25]
+
+- БД по умолчанию - SQLite-файл во временном каталоге: для каждого количества строк один раз заполняется шаблон,
+  перед каждым прогоном он копируется, поэтому прогоны воспроизводимы (запись в БД не накапливается).
+  --database - одноразовая БД MySQL (mysql+mysqlconnector://...): таблицы пересоздаются и заполняются заново
+- запросы идут через Flask test client (без waitress), с --concurrency потоками
+- по каждому сценарию: p50/p95/p99 задержки, запросов в секунду, SQL-запросов на запрос, ошибки,
+  пиковая память Python (tracemalloc) на один запрос
+- результаты сравниваются с --baseline (если файл есть): код возврата 1, если p95 или пропускная способность
+  хуже базовых больше чем на tolerance
+"""
+import argparse
+import gzip
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from tempfile import gettempdir
+from threading import Lock, local
+import sqlalchemy
+from sqlalchemy import create_engine, event, func, inspect
+from sqlalchemy.dialects.mysql import TINYINT
+from sqlalchemy.dialects.sqlite import DATETIME as SQLITE_DATETIME
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.schema import CreateColumn
+import compression
+import functions
+from general_function import encode_cursor
+import json_encoder
+import monthly_stats
+import my_engine
+import supervisions_cache
+from main_api import app, build
+from flask_jwt_extended import create_access_token
+from models import (Access, Artist, Contractor, DayType, PaidStatus, ResponsibleDepartment, StatusesExecution, StatusesK,
+                    Supervision, User, metadata)
+from search import create_search_index, has_search_index
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_api_baseline.json")
+BENCH_YEAR, BENCH_MONTH = 2023, 5
+SEED_START, SEED_END = datetime(2021, 1, 1), datetime(2024, 1, 1)
+SEED_BATCH = 10000
+MIN_SLOWDOWN_MS = 1
+STATIONS = [f"Станция {name}, путь {track}" for name in ("Северная", "Южная", "Заводская", "Лесная", "Речная", "Узловая",
+                                                       "Промышленная", "Сортировочная", "Пассажирская", "Товарная")
+            for track in range(1, 31)]
+TYPE_WORKS = ["Замена стрелочного перевода", "Ремонт рельсовой цепи", "Проверка сигнальной установки", "Укладка кабеля СЦБ",
+              "Замена шпал", "Выправка пути", "Монтаж светофора", "Ремонт переезда", "Замена изолирующих стыков", "Очистка кюветов"]
+
+# редкие и частые слова: "путь" есть в каждой строке, "светофор" - примерно в трети
+SEARCH_QUERIES = ["Лесная", "Речная ремонт переезда", "светофор", "стрелочного перевод", "Производитель 142", "кабел Узловая путь"]
+
+
+@compiles(TINYINT, "sqlite")
+def _compile_tinyint_sqlite(type_, compiler, **kw):
+    return "INTEGER"
+
+
+class _SqliteDateTime(SQLITE_DATETIME):
+    """MySQL принимает даты строками ('2023-05-01 08:00', как их присылает фронт), SQLite - только datetime"""
+
+    def bind_processor(self, dialect):
+        process = super().bind_processor(dialect)
+
+        def bind(value):
+            return process(datetime.fromisoformat(value) if isinstance(value, str) else value)
+        return bind
+
+
+def make_engine(url: str):
+    if url.startswith("sqlite"):
+        engine = create_engine(url, poolclass=my_engine.TimedQueuePool, pool_size=8, max_overflow=8,
+                               connect_args={"check_same_thread": False})
+        engine.dialect.colspecs = {**engine.dialect.colspecs, sqlalchemy.DateTime: _SqliteDateTime}
+        return engine
+    return create_engine(url, poolclass=my_engine.TimedQueuePool, pool_size=8, max_overflow=8, pool_pre_ping=True)
+
+
+def use_engine(engine):
+    """Переключает приложение на engine и сбрасывает кэши, привязанные к содержимому БД"""
+    my_engine.engine = monthly_stats.engine = engine
+    my_engine.my_session.configure(bind=engine)
+    functions._artist_ids = None
+    functions.invalidate_lists()
+    supervisions_cache.clear()
+
+
+def seed(engine, rows: int, rng: random.Random):
+    """Справочники, пользователь bench/bench и rows тех. надзоров за 2021-2023 годы"""
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+    lookups = {DayType: ["Будний", "Выходной", "Праздничный"], PaidStatus: ["Оплачено", "Не оплачено"],
+               ResponsibleDepartment: ["МТК", "СЦБ", "ПЧ", "ЭЧ", "ШЧ", "НГЧ"], StatusesExecution: ["Новая", "В работе", "Выполнена"],
+               StatusesK: ["Учтено в КС", "Не учтено в КС"], Access: ["Пользователь", "Администратор"]}
+    with engine.begin() as connection:
+        for model, names in lookups.items():
+            connection.execute(model.__table__.insert(), [{"name": name} for name in names])
+        connection.execute(Artist.__table__.insert(), [{"fio": f"Исполнитель {index} И. О."} for index in range(300)])
+        connection.execute(Contractor.__table__.insert(), [{"name": f"ООО «Подрядчик {index}»", "is_archived": int(index >= 70)}
+                                                           for index in range(80)])
+        connection.execute(User.__table__.insert(), [{"login": "bench", "password": "bench", "fio": "Бенчмарк", "access_id": 1}])
+
+        span = int((SEED_END - SEED_START).total_seconds() // 60)
+        for offset in range(0, rows, SEED_BATCH):
+            batch = []
+            for _ in range(min(SEED_BATCH, rows - offset)):
+                start = SEED_START + timedelta(minutes=rng.randrange(span))
+                batch.append({"datetime_start": start, "datetime_end": start + timedelta(hours=rng.randint(2, 12)),
+                              "day_type_id": rng.randint(1, 3), "station": rng.choice(STATIONS),
+                              "department_responsible_id": rng.randint(1, 6), "department_distance": f"ШЧ-{rng.randint(1, 20)}",
+                              "artist_id": rng.randint(1, 300) if rng.random() < 0.9 else None,
+                              "type_work": ", ".join(rng.sample(TYPE_WORKS, 3)),
+                              "contractor_id": rng.randint(1, 80) if rng.random() < 0.7 else None,
+                              "manufacturer_info": f"Производитель {rng.randint(1, 500)}, +7 900 {rng.randint(100, 999)}-00-00",
+                              "order_number": f"№ {rng.randint(1, 9999)}/{start.year % 100}",
+                              "note": "Примечание к работе " * rng.randint(0, 4) or None,
+                              "status_ks_id": rng.randint(1, 2), "comment": None, "paid_status_id": rng.choice((None, 1, 2)),
+                              "amount": rng.randint(1000, 100000), "status_execution_id": rng.randint(1, 3),
+                              "is_archived": int(rng.random() < 0.05)})
+            connection.execute(Supervision.__table__.insert(), batch)
+
+    use_engine(engine)
+    monthly_stats.rebuild_monthly_stats()
+
+
+def upgrade_template(connection):
+    """Дополняет шаблон, заполненный до изменений models.py: недостающие таблицы, колонки (со значением по умолчанию) и индексы"""
+    metadata.create_all(connection)
+    inspector = inspect(connection)
+    for table in metadata.sorted_tables:
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in columns:
+                connection.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {CreateColumn(column).compile(dialect=connection.dialect)}")
+
+        indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(connection)
+
+    if not has_search_index(connection):
+        create_search_index(connection)
+
+
+def prepare_database(url: str, rows: int):
+    """Возвращает engine с заполненной БД на rows строк"""
+    if url:
+        engine = make_engine(url)
+        seed(engine, rows, random.Random(rows))
+        return engine
+
+    template = os.path.join(gettempdir(), f"bench_api_{rows}.template.db")
+    template_engine = make_engine(f"sqlite:///{template}")
+    if not os.path.exists(template):
+        print(f"заполняю {template} ({rows} строк)...", flush=True)
+        seed(template_engine, rows, random.Random(rows))
+    with template_engine.begin() as connection:
+        upgrade_template(connection)
+    template_engine.dispose()
+
+    path = os.path.join(gettempdir(), f"bench_api_{rows}.db")
+    shutil.copyfile(template, path)
+    return make_engine(f"sqlite:///{path}")
+
+
+class QueryCounter:
+    """Количество SQL-запросов, выполненных через engine"""
+
+    def __init__(self, engine):
+        self.count = 0
+        self._lock = Lock()
+        event.listen(engine, "before_cursor_execute", self._count)
+
+    def _count(self, *args):
+        with self._lock:
+            self.count += 1
+
+
+def supervision_payload(rng: random.Random) -> dict:
+    start = datetime(BENCH_YEAR, BENCH_MONTH, rng.randint(1, 28), rng.randint(6, 12))
+    return {"datetime_start": start.strftime('%Y-%m-%d %H:%M'), "datetime_end": (start + timedelta(hours=8)).strftime('%Y-%m-%d %H:%M'),
+            "day_type_id": 1, "station": rng.choice(STATIONS), "department_responsible_id": 1, "department_distance": "ШЧ-4",
+            "artist": f"Исполнитель {rng.randint(0, 299)} И. О.", "type_work": rng.choice(TYPE_WORKS), "contractor_id": rng.randint(1, 70),
+            "manufacturer_info": "Петров Пётр, +7 900 000-00-00", "order_number": "№ 1/23", "note": None,
+            "status_ks_id": 2, "comment": None, "paid_status_id": None, "amount": 5000, "status_execution_id": 1}
+
+
+def _json(response):
+    """Тело JSON-ответа: make_client, как браузер, принимает сжатые ответы"""
+    if not response.is_json:
+        return None
+    data = response.get_data()
+    if response.headers.get("Content-Encoding") == "gzip":
+        data = gzip.decompress(data)
+    elif response.headers.get("Content-Encoding") == "br":
+        data = compression.brotli.decompress(data)
+    return json.loads(data)
+
+
+def _excel_job(client, rng, state):
+    job = _json(client.post(f"{build}/excel_load/jobs", json={"load_type": "inside", "year": BENCH_YEAR, "month": BENCH_MONTH}))
+    while True:
+        status = _json(client.get(f"{build}/excel_load/jobs/{job['job_id']}"))
+        if status["status"] not in ("queued", "running"):
+            break
+        time.sleep(0.01)
+    return client.get(f"{build}/excel_load/jobs/{job['job_id']}/file")
+
+
+def _patch(client, rng, state):
+    supervision_id = rng.randint(1, state.rows)
+    versions = state.thread.__dict__.setdefault("versions", {})
+    response = client.patch(f"{build}/supervisions/{supervision_id}", json={"version": versions.get(supervision_id, 0), "note": "bench"})
+    body = _json(response)
+    if body and "version" in body:
+        versions[supervision_id] = body["version"]
+    return response
+
+
+def _next_page(client, rng, state):
+    url = f"{build}/supervisions?date_start={BENCH_YEAR}-01-01&date_end={BENCH_YEAR}-12-31&sort_key=datetime_start&sort_by=ASC&limit=100"
+    cursor = getattr(state.thread, "cursor", None)
+    response = client.get(url + (f"&cursor={cursor}" if cursor else ""))
+    state.thread.cursor = _json(response)["next_cursor"]
+    return response
+
+
+def _changes(client, rng, state):
+    # тех. надзоры из шаблона не менялись (change_seq = 0), поток читает изменения, сделанные предыдущими сценариями
+    since = getattr(state.thread, "since", None) or encode_cursor([0, None])
+    response = client.get(f"{build}/supervisions/changes?since={since}&limit=100")
+    body = _json(response)
+    state.thread.since = body["since"] if body["has_more"] else None
+    return response
+
+
+def _month_uncached(client, rng, state):
+    # остальные сценарии списков после первого запроса отвечают из supervisions_cache
+    supervisions_cache.clear()
+    return client.get(f"{build}/supervisions?year={BENCH_YEAR}&month={BENCH_MONTH}")
+
+
+def _delete(client, rng, state):
+    with state.lock:
+        supervision_id = state.created.pop() if state.created else rng.randint(1, state.rows)
+    return client.delete(f"{build}/supervisions/{supervision_id}")
+
+
+def _lists_not_modified(client, rng, state):
+    if not getattr(state.thread, "etag", None):
+        state.thread.etag = client.get(f"{build}/lists").headers["ETag"]
+    return client.get(f"{build}/lists", headers={"If-None-Match": state.thread.etag})
+
+
+# (название, доля от --requests, функция (client, rng, state) -> response). Порядок важен: delete удаляет то, что добавил post
+SCENARIOS = [
+    ("health", 1, lambda client, rng, state: client.get(f"{build}/health")),
+    ("metrics", 1, lambda client, rng, state: client.get(f"{build}/metrics")),
+    ("auth", 1, lambda client, rng, state: client.post(f"{build}/auth", json={"login": "bench", "password": "bench"})),
+    ("lists", 1, lambda client, rng, state: client.get(f"{build}/lists")),
+    ("lists 304", 1, _lists_not_modified),
+    ("supervisions month", 1, lambda client, rng, state: client.get(f"{build}/supervisions?year={BENCH_YEAR}&month={BENCH_MONTH}")),
+    ("supervisions month uncached", 1, _month_uncached),
+    ("supervisions month sorted", 1, lambda client, rng, state: client.get(
+        f"{build}/supervisions?year={BENCH_YEAR}&month={BENCH_MONTH}&sort_key=station&sort_by=DESC")),
+    ("supervisions month stream", 1, lambda client, rng, state: client.get(f"{build}/supervisions?year={BENCH_YEAR}&month={BENCH_MONTH}&stream=true")),
+    ("supervisions year page", 1, _next_page),
+    ("supervisions search month", 1, lambda client, rng, state: client.get(
+        f"{build}/supervisions?year={BENCH_YEAR}&month={BENCH_MONTH}&q={rng.choice(SEARCH_QUERIES)}")),
+    ("supervisions search year page", 1, lambda client, rng, state: client.get(
+        f"{build}/supervisions?date_start={BENCH_YEAR}-01-01&date_end={BENCH_YEAR}-12-31&limit=50&q={rng.choice(SEARCH_QUERIES)}")),
+    ("supervision single", 1, lambda client, rng, state: client.get(f"{build}/supervisions/{rng.randint(1, state.rows)}")),
+    ("supervision post", 1, lambda client, rng, state: client.post(f"{build}/supervisions", json=supervision_payload(rng))),
+    ("supervision put", 1, lambda client, rng, state: client.put(f"{build}/supervisions/{rng.randint(1, state.rows)}", json=supervision_payload(rng))),
+    ("supervision patch", 1, _patch),
+    ("supervision delete", 1, _delete),
+    ("supervisions batch 100", 0.3, lambda client, rng, state: client.post(f"{build}/supervisions/batch", json=[supervision_payload(rng) for _ in range(100)])),
+    ("take_in_ks 100", 0.3, lambda client, rng, state: client.put(f"{build}/take_in_ks", json={
+        "take_in_ks_ids": rng.sample(range(1, state.rows + 1), min(50, state.rows)),
+        "not_take_in_ks_ids": rng.sample(range(1, state.rows + 1), min(50, state.rows))})),
+    ("supervisions changes", 1, _changes),
+    ("hours_analytics year", 1, lambda client, rng, state: client.get(
+        f"{build}/hours_analytics?year={BENCH_YEAR}&group_by={rng.choice(('contractor', 'department_responsible', 'artist', 'day_type'))}")),
+    ("supervisions_count_info", 1, lambda client, rng, state: client.get(f"{build}/supervisions_count_info?year={BENCH_YEAR}")),
+    ("excel month", 0.1, lambda client, rng, state: client.get(f"{build}/excel_load?year={BENCH_YEAR}&month={BENCH_MONTH}&load_type=inside")),
+    ("excel job month", 0.1, _excel_job),
+]
+
+
+class RunState:
+    """Общие для сценариев данные прогона: число строк, id добавленных тех. надзоров, данные потоков"""
+
+    def __init__(self, rows: int, created: list):
+        self.rows = rows
+        self.created = created
+        self.lock = Lock()
+        self.thread = local()
+
+
+def make_client(token: str):
+    client = app.test_client()
+    client.set_cookie("localhost", "access_token_cookie", token)
+    # ответы сжимаются, как для браузера: время включает сжатие (или его отсутствие при попадании в кэш сжатых ответов)
+    client.environ_base["HTTP_ACCEPT_ENCODING"] = "gzip, br"
+    return client
+
+
+def run_scenario(function, count: int, concurrency: int, state: RunState, token: str, counter: QueryCounter, seed_value: int) -> dict:
+    latencies = []
+    errors = 0
+    lock = Lock()
+
+    def worker(index: int):
+        nonlocal errors
+        client, rng = make_client(token), random.Random(seed_value * 1000 + index)
+        for _ in range(index, count, concurrency):
+            started = time.perf_counter()
+            response = function(client, rng, state)
+            response.get_data()  # потоковые ответы читаются до конца
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                errors += response.status_code >= 400 and response.status_code != 409
+
+    queries = counter.count
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(worker, range(concurrency)))
+    total = time.perf_counter() - started
+    queries = counter.count - queries
+
+    # память меряется отдельным запросом: tracemalloc сильно замедляет выполнение
+    tracemalloc.start()
+    function(make_client(token), random.Random(seed_value), state).get_data()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive") if len(latencies) > 1 else latencies * 99
+    return {"requests": len(latencies), "errors": errors,
+            "p50_ms": round(quantiles[49] * 1000, 2), "p95_ms": round(quantiles[94] * 1000, 2), "p99_ms": round(quantiles[98] * 1000, 2),
+            "rps": round(len(latencies) / total, 1), "queries_per_request": round(queries / len(latencies), 1),
+            "peak_mb": round(peak / 1024 / 1024, 2)}
+
+
+def run(rows: int, requests: int, concurrency: int, url: str) -> dict:
+    engine = prepare_database(url, rows)
+    use_engine(engine)
+    counter = QueryCounter(engine)
+    functions.warm_artists()
+    with my_engine.session_scope() as session:
+        last_id = session.query(func.max(Supervision.id)).scalar()
+    with app.app_context():
+        token = create_access_token(identity="bench")
+
+    state = RunState(rows, [])
+    results = {}
+    for index, (name, share, function) in enumerate(SCENARIOS):
+        count = max(concurrency, round(requests * share))
+        if name == "supervision delete":
+            with my_engine.session_scope() as session:
+                state.created = list(range(last_id + 1, session.query(func.max(Supervision.id)).scalar() + 1))
+        results[name] = run_scenario(function, count, concurrency, state, token, counter, index)
+        print(f"  {name:<28} {format_result(results[name])}", flush=True)
+
+    engine.dispose()
+    return results
+
+
+def format_result(result: dict) -> str:
+    return (f"p50 {result['p50_ms']:>9.2f} | p95 {result['p95_ms']:>9.2f} | p99 {result['p99_ms']:>9.2f} мс | "
+            f"{result['rps']:>7.1f} rps | {result['queries_per_request']:>6.1f} SQL | {result['peak_mb']:>8.2f} МБ | ошибок {result['errors']}")
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Сценарии, у которых p95 или rps хуже базовых больше чем на tolerance (и больше чем на MIN_SLOWDOWN_MS)"""
+    regressions = []
+    for rows, scenarios in results.items():
+        for name, result in scenarios.items():
+            base = baseline.get("results", {}).get(rows, {}).get(name)
+            if not base:
+                continue
+            p95 = result["p95_ms"] / base["p95_ms"] if base["p95_ms"] else 1
+            rps = result["rps"] / base["rps"] if base["rps"] else 1
+            # у сценариев быстрее миллисекунды разброс больше tolerance, такие отличия не считаются
+            slower_ms = max(result["p95_ms"] - base["p95_ms"], 1000 / result["rps"] - 1000 / base["rps"])
+            worse = (p95 > 1 + tolerance or rps < 1 / (1 + tolerance)) and slower_ms > MIN_SLOWDOWN_MS
+            print(f"{rows:>8} {name:<28} p95 x{p95:.2f}  rps x{rps:.2f}{'  <-- хуже базового' if worse else ''}")
+            if worse:
+                regressions.append((rows, name))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон main_api.py на синтетических данных")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 100000, 1000000])
+    parser.add_argument("--requests", type=int, default=30, help="запросов на сценарий (тяжёлые сценарии - доля от этого числа)")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--database", help="одноразовая БД вместо SQLite, её таблицы будут пересозданы")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    meta = {"date": datetime.now().strftime('%Y-%m-%d %H:%M'), "python": platform.python_version(), "platform": platform.platform(),
+            "cpu_count": os.cpu_count(), "sqlalchemy": sqlalchemy.__version__, "json": json_encoder.BACKEND,
+            "database": (args.database or "sqlite").split(":")[0], "requests": args.requests, "concurrency": args.concurrency}
+    results = {}
+    for rows in args.rows:
+        print(f"--- {rows} строк", flush=True)
+        results[str(rows)] = run(rows, args.requests, args.concurrency, args.database)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as file:
+            json.dump({"meta": meta, "results": results}, file, ensure_ascii=False, indent=2)
+
+    saved = args.save_baseline and os.path.abspath(args.save_baseline) == os.path.abspath(args.baseline)
+    if os.path.exists(args.baseline) and not saved:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        print(f"--- сравнение с {args.baseline} ({baseline['meta']['date']}, {baseline['meta']['platform']})")
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Сравнение выгрузки в Excel через write_only (excel_export.write_workbook) с прежней выгрузкой через обычную книгу.
+
+python3 bench_excel_export.py [кол-во строк ...] - по умолчанию 1000 10000 100000
+"""
+import sys
+import tracemalloc
+from datetime import datetime, timedelta
+from io import BytesIO
+from time import perf_counter
+import openpyxl
+from openpyxl.styles import Alignment, Font
+from excel_export import COLUMN_WIDTHS, HEADERS, _row_values, write_workbook
+
+
+def synthetic_rows(count: int):
+    """Словари вида Supervision.as_dict с правдоподобными длинами текстовых полей"""
+    start = datetime(2023, 1, 1, 8, 0)
+    for index in range(count):
+        datetime_start = start + timedelta(hours=index % 5000)
+        yield {"datetime_start": datetime_start.strftime('%Y-%m-%d %H:%M'),
+               "datetime_end": (datetime_start + timedelta(hours=8)).strftime('%Y-%m-%d %H:%M'),
+               "station": f"Станция {index % 300}, путь {index % 4 + 1}",
+               "department_distance": "ШЧ-4",
+               "artist": f"Иванов И. И. {index % 50}",
+               "type_work": "Замена стрелочного перевода, " * 3,
+               "manufacturer_info": "Петров Пётр, +7 900 000-00-00",
+               "order_number": f"№ {index}/23",
+               "note": "Примечание к работе " * 4,
+               "department_responsible": "МТК"}
+
+
+def legacy_workbook(rows, load_type: str) -> BytesIO:
+    """Прежний способ: обычная книга и отдельные Font/Alignment для каждой ячейки"""
+    wb = openpyxl.Workbook()
+    sheet = wb.create_sheet(title="Выгрузка", index=0)
+    sheet['A1'] = 'План работы МТК'
+    sheet.merge_cells(f"A1:{'N' if load_type == 'inside' else 'M'}1")
+    sheet.append(HEADERS[load_type])
+    for index, row in enumerate(rows, 1):
+        sheet.append(_row_values(index, row, load_type))
+
+    for column in sheet.columns:
+        for cell in column:
+            cell.font = Font(size=14, bold=False)
+            cell.alignment = Alignment(wrap_text=True)
+        column[1].font = Font(size=14, bold=True)
+        column[1].alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
+
+    sheet['A1'].alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
+    sheet['A1'].font = Font(size=22, bold=True)
+    sheet.row_dimensions[1].height = 80
+    for column, width in COLUMN_WIDTHS.items():
+        sheet.column_dimensions[column].width = width
+
+    result = BytesIO()
+    wb.save(result)
+    result.seek(0)
+    return result
+
+
+def measure(function, count: int) -> tuple:
+    """Возвращает (секунды, пиковая память Python в МБ)"""
+    tracemalloc.start()
+    started = perf_counter()
+    function(synthetic_rows(count), "inside").close()
+    elapsed = perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+if __name__ == "__main__":
+    counts = [int(item) for item in sys.argv[1:]] or [1000, 10000, 100000]
+    print(f"{'строк':>8} | {'legacy, с':>10} | {'legacy, МБ':>10} | {'write_only, с':>13} | {'write_only, МБ':>14}")
+    for count in counts:
+        legacy_time, legacy_peak = measure(legacy_workbook, count)
+        new_time, new_peak = measure(write_workbook, count)
+        print(f"{count:>8} | {legacy_time:>10.2f} | {legacy_peak:>10.1f} | {new_time:>13.2f} | {new_peak:>14.1f}")
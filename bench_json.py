@@ -0,0 +1,69 @@
+"""Сравнение кодирования ответа GET /supervisions: прежний flask.json.dumps и json_encoder.dumps (orjson или стандартный json).
+
+python3 bench_json.py [кол-во строк ...] - по умолчанию 1000 10000 50000
+"""
+import json as stdlib_json
+import sys
+from datetime import datetime, timedelta
+from time import perf_counter
+from flask import Flask, json
+import json_encoder
+from models import Supervision
+
+
+def synthetic_payload(count: int) -> list:
+    """Список словарей, как его возвращает get_supervisions (через Supervision.row_serializer).
+    Строка собирается по именам колонок, поэтому не зависит от их порядка и новых колонок модели
+    """
+    serialize = Supervision.row_serializer()
+    names = [column.name for column in Supervision.dict_columns()] + list(Supervision.__dict_lookups__)
+    start = datetime(2023, 1, 1, 8, 0)
+    result = []
+    for index in range(count):
+        datetime_start = start + timedelta(hours=index % 5000)
+        values = {"id": index, "datetime_start": datetime_start, "datetime_end": datetime_start + timedelta(hours=8),
+                  "day_type_id": 1, "station": f"Станция {index % 300}, путь {index % 4 + 1}", "department_responsible_id": 2,
+                  "department_distance": "ШЧ-4", "artist_id": index % 50, "type_work": "Замена стрелочного перевода, " * 3,
+                  "contractor_id": index % 20, "manufacturer_info": "Петров Пётр, +7 900 000-00-00", "order_number": f"№ {index}/23",
+                  "note": "Примечание к работе " * 4, "status_ks_id": 1, "comment": None, "paid_status_id": 2, "amount": 1,
+                  "status_execution_id": 1, "is_archived": 0, "version": 0, "change_seq": index,
+                  "artist": f"Иванов И. И. {index % 50}", "contractor": f"ООО «Подрядчик {index % 20}»", "day_type": "Рабочий день",
+                  "department_responsible": "МТК", "paid_status": "Не оплачено", "status_execution": "Выполнено",
+                  "status_ks": "Принято в КС"}
+        result.append(serialize(tuple(values.get(name) for name in names)))
+    return result
+
+
+def stdlib_dumps(body) -> bytes:
+    """Запасной вариант json_encoder без orjson"""
+    return stdlib_json.dumps(body, ensure_ascii=False, separators=(",", ":"), default=json_encoder._default).encode()
+
+
+def measure(function, body, repeat: int) -> float:
+    """Лучшее время из repeat запусков, мс"""
+    best = None
+    for _ in range(repeat):
+        started = perf_counter()
+        function(body)
+        elapsed = perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+if __name__ == "__main__":
+    counts = [int(item) for item in sys.argv[1:]] or [1000, 10000, 50000]
+    app = Flask(__name__)
+    # прежний путь: flask.json.dumps возвращает str, Response затем кодирует её в UTF-8
+    encoders = {"flask.json": lambda body: json.dumps(body, ensure_ascii=False).encode(),
+                "json": stdlib_dumps}
+    if json_encoder.orjson is not None:
+        encoders["orjson"] = json_encoder.dumps
+
+    print(f"бэкенд json_encoder: {json_encoder.BACKEND}")
+    print(f"{'строк':>8} | {'МБ':>6} | " + " | ".join(f"{name + ', мс':>14}" for name in encoders))
+    with app.app_context():
+        for count in counts:
+            body = synthetic_payload(count)
+            size = len(json_encoder.dumps(body)) / 1024 / 1024
+            times = [measure(function, body, 5) for function in encoders.values()]
+            print(f"{count:>8} | {size:>6.1f} | " + " | ".join(f"{item:>14.1f}" for item in times))
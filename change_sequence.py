@@ -0,0 +1,30 @@
+from sqlalchemy import exc
+from sqlalchemy.orm import Session
+from models import SupervisionChangeSequence
+
+_SEQUENCE_ID = 1
+
+
+def next_change_seq(session: Session) -> int:
+    """Следующий номер изменения тех. надзоров, записывается в supervisions.change_seq изменённых строк.\n
+    Вызывается в начале пишущей транзакции: UPDATE блокирует строку счётчика до commit, поэтому
+    транзакции с меньшими номерами всегда видны раньше, чем с большими, и GET /supervisions/changes ничего не пропускает
+    """
+    while True:
+        updated = session.query(SupervisionChangeSequence).filter(SupervisionChangeSequence.id == _SEQUENCE_ID) \
+                         .update({"value": SupervisionChangeSequence.value + 1}, synchronize_session=False)
+        if updated:
+            return session.query(SupervisionChangeSequence.value).filter(SupervisionChangeSequence.id == _SEQUENCE_ID).scalar()
+
+        # первое изменение после создания таблицы: строку счётчика мог одновременно добавить другой запрос
+        try:
+            with session.begin_nested():
+                session.add(SupervisionChangeSequence(id=_SEQUENCE_ID, value=1))
+            return 1
+        except exc.IntegrityError:
+            continue
+
+
+def current_change_seq(session: Session) -> int:
+    """Номер последнего изменения, 0 - изменений ещё не было"""
+    return session.query(SupervisionChangeSequence.value).filter(SupervisionChangeSequence.id == _SEQUENCE_ID).scalar() or 0
@@ -0,0 +1,108 @@
+import gzip
+import zlib
+from threading import Lock
+from flask import Request, Response
+from config import API
+
+try:
+    import brotli
+except ImportError:  # brotli необязателен, без него ответы сжимаются только gzip
+    brotli = None
+
+# Ответы меньше COMPRESS_MIN_SIZE байт отдаются как есть: выигрыш меньше затрат на сжатие
+COMPRESS_MIN_SIZE = API.getint("compress_min_size", fallback=1024)
+GZIP_LEVEL = API.getint("gzip_level", fallback=6)
+BROTLI_QUALITY = API.getint("brotli_quality", fallback=5)
+COMPRESSIBLE_MIMETYPES = {"application/json", "text/plain", "text/html", "text/csv"}
+
+
+def _encodings() -> list:
+    """Поддерживаемые кодировки в порядке предпочтения"""
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def choose_encoding(request: Request, size: int = None):
+    """Кодировка по Accept-Encoding запроса или None (клиент не принимает сжатие или тело меньше COMPRESS_MIN_SIZE).\n
+    size = None - размер заранее неизвестен (потоковый ответ)
+    """
+    if size is not None and size < COMPRESS_MIN_SIZE:
+        return None
+
+    accepted = [(request.accept_encodings.quality(encoding), encoding) for encoding in _encodings()]
+    quality, encoding = max(accepted, key=lambda item: item[0])  # при равном q остаётся первая (br)
+    return encoding if quality > 0 else None
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def _compress_stream(chunks, encoding: str):
+    """Сжимает потоковый ответ по частям: каждая часть сбрасывается клиенту сразу, не дожидаясь конца"""
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        for chunk in chunks:
+            yield compressor.process(chunk) + compressor.flush()
+        yield compressor.finish()
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # wbits=31 - формат gzip
+        for chunk in chunks:
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+
+def _is_compressible(response: Response) -> bool:
+    return (200 <= response.status_code < 300 and response.status_code != 204
+            and response.mimetype in COMPRESSIBLE_MIMETYPES
+            and "Content-Encoding" not in response.headers
+            and not response.direct_passthrough)  # send_file - xlsx уже сжат
+
+
+def compress_response(request: Request, response: Response) -> Response:
+    """Сжимает ответ gzip или brotli, если клиент это принимает (для app.after_request)"""
+    if not _is_compressible(response):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    if response.is_streamed:
+        encoding = choose_encoding(request)
+        if encoding:
+            response.response = _compress_stream(response.response, encoding)
+            response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        encoding = choose_encoding(request, len(data))
+        if encoding:
+            response.set_data(compress(data, encoding))
+
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    return response
+
+
+class CompressedCache:
+    """Готовые тела ответа (JSON и его сжатые варианты) для неизменного содержимого, например /lists.\n
+    Хранится только последний ключ (etag): при смене содержимого старые варианты выбрасываются
+    """
+
+    def __init__(self):
+        self._key = None
+        self._bodies = {}
+        self._lock = Lock()
+
+    def get(self, key: str, encoding, encode) -> bytes:
+        """Тело для key в кодировке encoding (None - без сжатия). encode() -> bytes вызывается только при промахе"""
+        with self._lock:
+            if key != self._key:
+                self._key, self._bodies = key, {}
+            body = self._bodies.get(encoding)
+        if body is not None:
+            return body
+
+        body = encode() if encoding is None else compress(self.get(key, None, encode), encoding)
+        with self._lock:
+            if key == self._key:
+                self._bodies[encoding] = body
+        return body
@@ -0,0 +1,82 @@
+from datetime import datetime
+from tempfile import SpooledTemporaryFile
+from typing import Iterable
+import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Font, NamedStyle
+from openpyxl.utils import get_column_letter
+from general_function import hours_between_dates
+
+# Файл держится в памяти, пока не превысит этот размер, дальше пишется во временный файл на диске
+SPOOL_MAX_SIZE = 10 * 1024 * 1024
+
+HEADERS = {
+    "outside": ["№ п/п", "Дата, время начала работ", "Дата, время окончания работ",
+                "Время, всего", "Станция (место проведения работ)", "Отдел, Дистанция", "Ф. И. О. осуществляющего технический надзор",
+                "Вид проводимой работы (объем произведенной работы)", "Название сторонней организации",
+                "Фамилия, Имя, телефон производителя", "Номер совместного приказа", "Примечание", "Подпись работника"],
+    "inside": ["№ п/п", "Дата, время начала работ", "Дата, время окончания работ",
+               "Время, всего", "Станция (место проведения работ)", "Отдел, Дистанция", "Ф. И. О. осуществляющего технический надзор",
+               "Вид проводимой работы (объем произведенной работы)", "Название сторонней организации",
+               "Фамилия, Имя, телефон производителя", "Номер совместного приказа", "Примечание", "Подпись работника", "Ответственное подразделение"],
+}
+
+COLUMN_WIDTHS = {"A": 17, "B": 23, "C": 23, "D": 20, "E": 50, "F": 14, "G": 22,
+                 "H": 53, "I": 31, "J": 27, "K": 36, "L": 60, "M": 20, "N": 20}
+
+
+def _named_styles() -> list:
+    """Стили создаются один раз на книгу и разделяются всеми ячейками"""
+    title = NamedStyle(name="title", font=Font(size=22, bold=True),
+                       alignment=Alignment(horizontal='center', vertical='center', wrap_text=True))
+    header = NamedStyle(name="header", font=Font(size=14, bold=True),
+                        alignment=Alignment(horizontal='center', vertical='center', wrap_text=True))
+    body = NamedStyle(name="body", font=Font(size=14, bold=False), alignment=Alignment(wrap_text=True))
+    return [title, header, body]
+
+
+def _row_values(index: int, row: dict, load_type: str) -> list:
+    values = [index, datetime.strptime(row["datetime_start"], '%Y-%m-%d %H:%M').strftime('%d.%m.%Y %H:%M'),
+              datetime.strptime(row["datetime_end"], '%Y-%m-%d %H:%M').strftime('%d.%m.%Y %H:%M'),
+              hours_between_dates(row["datetime_start"], row["datetime_end"]),
+              row["station"], row["department_distance"], row["artist"], row["type_work"],
+              'test', row["manufacturer_info"],
+              row["order_number"], row["note"], ""]
+    if load_type == "inside":
+        values.append(row["department_responsible"])
+    return values
+
+
+def write_workbook(rows: Iterable[dict], load_type: str, output=None):
+    """Выгрузка тех. надзоров в xlsx в режиме write_only.\n
+    rows - итерируемые словари вида Supervision.as_dict (например генератор по порциям строк из БД),
+    строки пишутся в файл сразу и не накапливаются в памяти.
+    output - файл для записи, по умолчанию SpooledTemporaryFile. Возвращает файл, перемотанный на начало
+    """
+    wb = openpyxl.Workbook(write_only=True)
+    for style in _named_styles():
+        wb.add_named_style(style)
+
+    sheet = wb.create_sheet(title="Выгрузка")
+    headers = HEADERS[load_type]
+
+    # размеры и объединения задаются до записи первой строки
+    for column, width in COLUMN_WIDTHS.items():
+        sheet.column_dimensions[column].width = width
+    sheet.row_dimensions[1].height = 80
+    sheet.merged_cells.add(f"A1:{get_column_letter(len(headers))}1")
+
+    def cell(value, style: str) -> WriteOnlyCell:
+        result = WriteOnlyCell(sheet, value=value)
+        result.style = style
+        return result
+
+    sheet.append([cell('План работы МТК', "title")] + [cell(None, "body") for _ in headers[1:]])
+    sheet.append([cell(value, "header") for value in headers])
+    for index, row in enumerate(rows, 1):
+        sheet.append([cell(value, "body") for value in _row_values(index, row, load_type)])
+
+    result = output if output is not None else SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    wb.save(result)
+    result.seek(0)
+    return result
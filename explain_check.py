@@ -0,0 +1,61 @@
+import sys
+from functions import _supervisions_filter, _supervisions_order
+from models import Supervision
+from my_engine import session_scope
+
+# Фильтры, которые присылает фронт в GET /supervisions (см. TechnicalSupervisions.parser_get)
+CHECKED_FILTERS = {
+    "month": {"year": 2023, "month": 5},
+    "month, sort": {"year": 2023, "month": 5, "sort_key": "datetime_start", "sort_by": "ASC"},
+    "month, status_ks": {"year": 2023, "month": 5, "status_ks_id": 1},
+    "month, contractor": {"year": 2023, "month": 5, "contractor_id": 1},
+    "date range": {"date_start": "2023-01-01", "date_end": "2023-12-31"},
+}
+
+
+def explain(session, statement) -> list:
+    """Возвращает план выполнения запроса в виде списка словарей (EXPLAIN для MySQL, EXPLAIN QUERY PLAN для SQLite)"""
+    connection = session.connection()
+    compiled = statement.compile(dialect=connection.dialect)
+    prefix = "EXPLAIN QUERY PLAN " if connection.dialect.name == "sqlite" else "EXPLAIN "
+    if compiled.positional:
+        params = tuple(compiled.params[name] for name in compiled.positiontup)
+    else:
+        params = compiled.params
+
+    result = connection.exec_driver_sql(prefix + compiled.string, params)
+    return [dict(row._mapping) for row in result]
+
+
+def is_full_scan(dialect_name: str, plan: list) -> bool:
+    """True, если в плане таблица supervisions читается полным перебором"""
+    table = Supervision.__tablename__
+    if dialect_name == "sqlite":
+        return any(row["detail"].startswith(f"SCAN {table}") and "INDEX" not in row["detail"] for row in plan)
+
+    return any(row["table"] == table and row["type"] == "ALL" for row in plan)
+
+
+def check() -> list:
+    """Проверяет планы запросов списка тех. надзоров. Возвращает названия фильтров, для которых выполняется полный перебор"""
+    failed = []
+    with session_scope() as session:
+        for name, my_filter in CHECKED_FILTERS.items():
+            query, _ = _supervisions_filter(my_filter)
+            plan = explain(session, Supervision.row_select().where(*query).order_by(*_supervisions_order(my_filter)))
+            full_scan = is_full_scan(session.connection().dialect.name, plan)
+            print(f"--- {name}: {'FULL SCAN' if full_scan else 'ok'}")
+            for row in plan:
+                print(row)
+
+            if full_scan:
+                failed.append(name)
+
+    return failed
+
+
+if __name__ == "__main__":
+    # python3 explain_check.py - вывести планы запросов и завершиться с кодом 1, если какой-то из них перебирает всю таблицу
+    failed = check()
+    print("Полный перебор таблицы:", ", ".join(failed) if failed else "нет")
+    sys.exit(1 if failed else 0)
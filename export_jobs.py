@@ -0,0 +1,196 @@
+import json
+import os
+import re
+import stat
+from concurrent.futures import ThreadPoolExecutor, wait
+from tempfile import gettempdir
+from threading import Lock
+from time import time
+from uuid import uuid4
+from config import API
+from functions import count_supervisions, excel_load
+
+# Одновременно строится не больше EXPORT_WORKERS выгрузок (в каждом процессе), остальные ждут в очереди.
+# Готовые файлы хранятся EXPORT_TTL секунд с момента завершения
+EXPORT_WORKERS = API.getint("export_workers", fallback=2)
+EXPORT_TTL = API.getint("export_ttl", fallback=600)
+# Состояние задач и файлы лежат в EXPORT_DIR, а не в памяти процесса: при запуске через server.py
+# опрос статуса и скачивание могут попасть в другой рабочий процесс
+EXPORT_DIR = API.get("export_dir", fallback=os.path.join(gettempdir(), "technical_supervision_exports"))
+# Выгрузки содержат данные тех. надзоров, поэтому каталог и файлы доступны только пользователю, под которым запущен API
+_DIR_MODE = 0o700
+_FILE_MODE = 0o600
+
+_executor = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix="export")
+_job_id_re = re.compile(r"[0-9a-f]{32}")
+# Незавершённые выгрузки этого процесса: job_id -> (задача, future). Нужны shutdown_jobs при остановке процесса
+_jobs = {}
+_jobs_lock = Lock()
+
+
+def _job_info(job: dict) -> dict:
+    return {key: job[key] for key in ("job_id", "status", "done", "total", "message")}
+
+
+def _state_path(job_id: str) -> str:
+    return os.path.join(EXPORT_DIR, f"{job_id}.json")
+
+
+def _file_path(job_id: str) -> str:
+    """Путь к файлу выгрузки строится только из job_id, а не из состояния задачи"""
+    return os.path.join(EXPORT_DIR, f"{job_id}.xlsx")
+
+
+def _open_private(path: str, mode: str):
+    """Открывает файл на запись с правами 0600 (не зависит от umask)"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_NOFOLLOW", 0), _FILE_MODE)
+    return os.fdopen(fd, mode)
+
+
+def _prepare_dir():
+    """Создаёт EXPORT_DIR с правами 0700. Если каталог уже есть, он должен принадлежать текущему пользователю:
+    иначе другой пользователь мог подложить в него состояние задачи или читать выгрузки
+    """
+    os.makedirs(EXPORT_DIR, mode=_DIR_MODE, exist_ok=True)
+    info = os.lstat(EXPORT_DIR)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+        raise RuntimeError(f"Каталог выгрузок {EXPORT_DIR} не является каталогом или принадлежит другому пользователю")
+    if stat.S_IMODE(info.st_mode) != _DIR_MODE:
+        os.chmod(EXPORT_DIR, _DIR_MODE)
+
+
+def _save_job(job: dict):
+    """Атомарно записывает состояние задачи (читатели не увидят недописанный файл)"""
+    path = _state_path(job["job_id"])
+    with _open_private(f"{path}.tmp", "w") as state:
+        json.dump(job, state)
+    os.replace(f"{path}.tmp", path)
+
+
+def _load_job(job_id: str) -> dict:
+    try:
+        with open(_state_path(job_id)) as state:
+            return json.load(state)
+    except (OSError, ValueError):
+        return None
+
+
+def _update_job(job: dict):
+    """Сохраняет состояние из потока выгрузки, если задачу ещё не прервал shutdown_jobs"""
+    with _jobs_lock:
+        if job["job_id"] in _jobs:
+            _save_job(job)
+
+
+def _run_job(job: dict, load_type: str, supervision_ids: list, my_filter: dict):
+    job["status"] = "running"
+    _update_job(job)
+
+    def progress(done):
+        job["done"] = done
+        _update_job(job)
+
+    try:
+        with _open_private(_file_path(job["job_id"]), "wb") as output:
+            excel_load(load_type, supervision_ids, my_filter, output, progress)
+        job["done"] = job["total"]
+        job["status"] = "done"
+    except Exception as e:
+        job["status"] = "error"
+        job["message"] = str(e)
+    finally:
+        job["finished_at"] = time()
+        with _jobs_lock:
+            if _jobs.pop(job["job_id"], None):
+                _save_job(job)
+
+
+def _remove_job(job_id: str):
+    for path in (_file_path(job_id), _state_path(job_id)):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def cleanup_jobs():
+    """Удаляет задачи (и их файлы), завершившиеся больше EXPORT_TTL секунд назад,
+    а также незавершённые задачи, состояние которых не обновлялось EXPORT_TTL секунд (процесс, строивший выгрузку, остановлен)
+    """
+    _prepare_dir()
+    now = time()
+    for name in os.listdir(EXPORT_DIR):
+        job_id, extension = os.path.splitext(name)
+        job = _load_job(job_id) if extension == ".json" else None
+        if not job:
+            continue
+        try:
+            last_change = job["finished_at"] or os.path.getmtime(_state_path(job_id))
+        except OSError:
+            continue
+        if now - last_change > EXPORT_TTL:
+            _remove_job(job_id)
+
+
+def start_export(owner: str, load_type: str, supervision_ids: list = None, my_filter: dict = None) -> tuple:
+    """Ставит выгрузку в очередь (параметры как у functions.excel_load).
+    Возвращает информацию о задаче (в т.ч. job_id для опроса статуса)
+    """
+    cleanup_jobs()
+    if supervision_ids is None:
+        total, status = count_supervisions(my_filter)
+        if status != 200:
+            return total, status
+    else:
+        total = len(supervision_ids)
+
+    job_id = uuid4().hex
+    job = {"job_id": job_id, "owner": owner, "status": "queued", "done": 0, "total": total,
+           "message": None, "finished_at": None}
+    _save_job(job)
+
+    with _jobs_lock:
+        _jobs[job_id] = (job, _executor.submit(_run_job, job, load_type, supervision_ids, my_filter))
+    return _job_info(job), 202
+
+
+def _get_job(owner: str, job_id: str) -> dict:
+    _prepare_dir()
+    job = _load_job(job_id) if _job_id_re.fullmatch(job_id) else None
+    return job if job and job["owner"] == owner else None
+
+
+def get_export_status(owner: str, job_id: str) -> tuple:
+    cleanup_jobs()
+    job = _get_job(owner, job_id)
+    if not job:
+        return {"message": f"Выгрузка {job_id} не найдена"}, 404
+
+    return _job_info(job), 200
+
+
+def get_export_file(owner: str, job_id: str) -> tuple:
+    """Возвращает (путь к готовому файлу, 200) или (сообщение об ошибке, статус)"""
+    job = _get_job(owner, job_id)
+    if not job:
+        return {"message": f"Выгрузка {job_id} не найдена"}, 404
+    if job["status"] != "done":
+        return {"message": "Выгрузка ещё не готова" if job["status"] in ("queued", "running") else "Выгрузка завершилась с ошибкой"}, 409
+
+    return _file_path(job_id), 200
+
+
+def shutdown_jobs(timeout: float):
+    """Остановка процесса (server.py): выгрузки из очереди отменяются, начатые достраиваются не дольше timeout секунд.
+    Выгрузки, которые не успели завершиться, помечаются ошибкой, чтобы клиент не опрашивал их статус до истечения EXPORT_TTL
+    """
+    _executor.shutdown(wait=False, cancel_futures=True)
+    with _jobs_lock:
+        futures = [future for _, future in _jobs.values()]
+    wait(futures, timeout=max(timeout, 0))
+
+    with _jobs_lock:
+        for job, _ in _jobs.values():
+            job["status"] = "error"
+            job["message"] = "Выгрузка прервана остановкой сервера, запустите её заново"
+            job["finished_at"] = time()
+            _save_job(job)
+        _jobs.clear()
@@ -1,37 +1,142 @@
 from datetime import datetime
-import openpyxl
-from openpyxl.styles import Alignment, Font
-from sqlalchemy import desc
+from hashlib import sha1
+import json
+import logging
+from threading import Lock
+from time import monotonic
+from sqlalchemy import and_, case, desc, func, or_
 import sqlalchemy
-from general_function import compare_dates, general_filter, hours_between_dates
+from sqlalchemy.engine import CursorResult
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import Select
+from change_sequence import current_change_seq, next_change_seq
+from compression import compress
+from excel_export import write_workbook
+from general_function import chunks, compare_dates, days_range, decode_cursor, encode_cursor, general_filter, month_range
+from json_encoder import EncodedJson, dumps
 from models import Artist, Contractor, DayType, PaidStatus, ResponsibleDepartment, StatusesExecution, StatusesK, Supervision, User
-from my_engine import session_scope
-from io import BytesIO
+from monthly_stats import apply_supervisions, apply_values, count_by_month, get_year_stats
+from my_engine import pool_status, session_scope
+from search import parse_query, search_match, search_results
+import supervisions_cache
 
 
 def authorization(login: str, password: str) -> tuple:
     with session_scope() as session:
-        user = session.query(User).filter(User.login == login,
-                                          User.password == password).one_or_none()
+        user = read_rows(session, User.row_select().where(User.login == login,
+                                                          User.password == password)).one_or_none()
     
         if not user:
             return {"message": "Неверный логин или пароль"}, 401
         else:        
-            return user.as_dict(), 200
+            return User.row_serializer()(user), 200
 
 
-def get_lists():
+# Кэш справочников для get_lists. version увеличивается при каждой записи в справочники (invalidate_lists),
+# кэш перечитывается из БД, если version изменилась или истёк LISTS_CACHE_TTL (записи из других процессов)
+LISTS_CACHE_TTL = 60
+_lists_cache = {"version": 0, "loaded_version": None, "loaded_at": 0.0, "result": None, "etag": None}
+_lists_lock = Lock()
+
+
+def invalidate_lists():
+    """Сбросить кэш справочников. Вызывать после любой записи в artists, contractors и другие справочники"""
+    with _lists_lock:
+        _lists_cache["version"] += 1
+
+
+def _load_lists() -> dict:
     result = {}
     with session_scope() as session:
-        result["artists"] = [item.as_dict() for item in session.query(Artist).all()]
-        result["contractors"] = [dict_item for item in session.query(Contractor).all() if (dict_item := item.as_dict()) and dict_item["is_archived"] == 0]
-        result["day_types"] = [item.as_dict() for item in session.query(DayType).all()]
-        result["paid_statuses"] = [item.as_dict() for item in session.query(PaidStatus).all()]
-        result["statuses_execution"] = [item.as_dict() for item in session.query(StatusesExecution).all()]
-        result["statuses_ks"] = [item.as_dict() for item in session.query(StatusesK).all()]
-        result["responsible_departments"] = [item.as_dict() for item in session.query(ResponsibleDepartment).all()]
-    
-    return result, 200
+        for key, model in (("artists", Artist), ("contractors", Contractor), ("day_types", DayType), ("paid_statuses", PaidStatus),
+                           ("statuses_execution", StatusesExecution), ("statuses_ks", StatusesK), ("responsible_departments", ResponsibleDepartment)):
+            statement = model.row_select()
+            if model is Contractor:
+                statement = statement.where(Contractor.is_archived == 0)
+            serialize = model.row_serializer()
+            result[key] = [serialize(row) for row in read_rows(session, statement)]
+
+    return result
+
+
+def health() -> tuple:
+    """Проверка соединения с БД и состояние пула соединений"""
+    try:
+        with session_scope() as session:
+            session.execute(sqlalchemy.text("SELECT 1"))
+        database = "ok"
+    except sqlalchemy.exc.SQLAlchemyError:
+        # текст ошибки может содержать адрес и имя пользователя БД, поэтому он только пишется в лог
+        logging.getLogger("health").exception("Проверка соединения с БД не прошла")
+        database = "error"
+
+    return {"database": database, "pool": pool_status()}, 200 if database == "ok" else 503
+
+
+def get_lists() -> tuple:
+    """Выпадающие списки. Возвращает (справочники, статус, etag); etag - хэш содержимого, одинаковый во всех процессах"""
+    with _lists_lock:
+        version = _lists_cache["version"]
+        if _lists_cache["loaded_version"] == version and monotonic() - _lists_cache["loaded_at"] < LISTS_CACHE_TTL:
+            return _lists_cache["result"], 200, _lists_cache["etag"]
+
+    result = _load_lists()
+    etag = sha1(json.dumps(result, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+    with _lists_lock:
+        # пока читали БД, справочники могли измениться - тогда не сохраняем устаревший результат
+        if _lists_cache["version"] == version:
+            _lists_cache.update(loaded_version=version, loaded_at=monotonic(), result=result, etag=etag)
+
+    return result, 200, etag
+
+
+def read_rows(session: Session, statement: Select) -> CursorResult:
+    """Выполняет select() (обычно model.row_select()) на соединении сессии мимо ORM: без identity map
+    и построения объектов, строки - лёгкие кортежи для row_serializer.
+    Скомпилированный SQL кэшируется движком по структуре запроса, значения фильтров передаются параметрами
+    """
+    return session.connection().execute(statement)
+
+
+# Кэш fio -> id исполнителя. Заполняется целиком при первом обращении (или warm_artists при старте)
+# и пополняется после каждой успешной вставки, поэтому повторяющиеся fio не обращаются к БД
+_artist_ids = None
+_artists_lock = Lock()
+
+
+def warm_artists():
+    """Загрузить всех исполнителей в кэш fio -> id"""
+    global _artist_ids
+    with session_scope() as session:
+        artist_ids = dict(session.query(Artist.fio, Artist.id).all())
+
+    with _artists_lock:
+        _artist_ids = artist_ids if _artist_ids is None else {**artist_ids, **_artist_ids}
+
+
+def _cached_artist_ids(fios) -> dict:
+    if _artist_ids is None:
+        warm_artists()
+
+    with _artists_lock:
+        return {fio: _artist_ids[fio] for fio in fios if fio in _artist_ids}
+
+
+def _cache_artist_ids(artist_ids: dict):
+    with _artists_lock:
+        _artist_ids.update(artist_ids)
+
+
+def _insert_or_get_artist(session: Session, artist_fio: str) -> tuple:
+    """Атомарно добавляет исполнителя или находит существующего (уникальный индекс по artists.fio).\n
+    Возвращает (id, True если исполнитель добавлен)
+    """
+    try:
+        with session.begin_nested():
+            result = session.execute(sqlalchemy.insert(Artist).values(fio=artist_fio))
+        return result.inserted_primary_key[0], True
+    except sqlalchemy.exc.IntegrityError:
+        return session.query(Artist.id).filter(Artist.fio == artist_fio).scalar(), False
 
 
 def create_new_artist(artist_fio: str) -> int:
@@ -40,15 +145,16 @@ def create_new_artist(artist_fio: str) -> int:
     В случае если такое fio уже есть в списке, возвращает id найденного исполнителя.\n
     Возвращает id нового или найденного исполнителя
     """
+    artist_id = _cached_artist_ids([artist_fio]).get(artist_fio)
+    if artist_id:
+        return artist_id
+
     with session_scope() as session:
-        artist: Artist = session.query(Artist).filter(Artist.fio == artist_fio).one_or_none()
-        if artist:
-            artist_id = artist.id
-        else:
-            artist: Artist = Artist(fio=artist_fio)
-            session.add(artist)
-            session.commit()
-            artist_id = artist.id
+        artist_id, inserted = _insert_or_get_artist(session, artist_fio)
+
+    _cache_artist_ids({artist_fio: artist_id})
+    if inserted:
+        invalidate_lists()
 
     return artist_id
 
@@ -63,27 +169,138 @@ def add_supervision(kwargs: dict) -> tuple:
 
     try:
         with session_scope() as session:
-            session.add(Supervision(**kwargs))
+            supervision = Supervision(**kwargs, change_seq=next_change_seq(session))
+            session.add(supervision)
+            session.flush()
+            months = apply_supervisions(session, [supervision.id], 1)
     except sqlalchemy.exc.IntegrityError:
         return {"message": "Вы пытаетесь добавить некорректное значение списка"}, 400
     except sqlalchemy.exc.DataError:
         return {"message": "Вы пытаетесь добавить некорректное значение даты"}, 400
 
+    supervisions_cache.invalidate(months)
     return None, 200
 
 
-def get_supervisions(my_filter: dict) -> tuple:
-    """Получение всех тех. надзоров, с фильтрацией (если нужна) и сортировкой"""
-    query = [Supervision.is_archived == 0]
+# Значения server_default, которые нужно подставлять явно при вставке через executemany
+SUPERVISION_DEFAULTS = {"status_ks_id": 2, "status_execution_id": 1}
+
+# Поле тех. надзора -> справочник из get_lists, в котором должно находиться его значение
+SUPERVISION_LISTS = {"day_type_id": "day_types", "department_responsible_id": "responsible_departments",
+                     "contractor_id": "contractors", "status_ks_id": "statuses_ks",
+                     "status_execution_id": "statuses_execution", "paid_status_id": "paid_statuses"}
+
+
+def _resolve_artists(session: Session, fios: set) -> tuple:
+    """Возвращает ({fio: id} для всех переданных fio, были ли добавлены новые исполнители).\n
+    Известные fio берутся из кэша, отсутствующие добавляются одним INSERT, а если его опередил
+    параллельный запрос - по одному через _insert_or_get_artist. Кэш обновляет вызывающий после commit
+    """
+    artists = _cached_artist_ids(fios)
+    missing = fios - artists.keys()
+    if not missing:
+        return artists, False
+
+    try:
+        with session.begin_nested():
+            session.execute(sqlalchemy.insert(Artist), [{"fio": fio} for fio in missing])
+        artists.update(session.query(Artist.fio, Artist.id).filter(Artist.fio.in_(missing)).all())
+    except sqlalchemy.exc.IntegrityError:
+        for fio in missing:
+            artists[fio] = _insert_or_get_artist(session, fio)[0]
+
+    return artists, True
+
+
+def add_supervisions(items: list, errors: list) -> tuple:
+    """Пакетное добавление тех. надзоров одной транзакцией.\n
+    - items - словари, разобранные по правилам TechnicalSupervisions.parser, None на месте элементов, не прошедших разбор
+    - errors - ошибки разбора вида {"index": номер элемента, "message": ...}
+
+    Если хотя бы один элемент некорректен, ничего не добавляется и возвращаются ошибки по каждому элементу
+    """
+    lists = get_lists()[0]
+    list_ids = {name: {item["id"] for item in lists[name]} for name in SUPERVISION_LISTS.values()}
+
+    rows, errors, months = [], list(errors), set()
+    for index, item in enumerate(items):
+        if item is None:
+            continue
+
+        row = general_filter(item)
+        for key, default in SUPERVISION_DEFAULTS.items():
+            if row.get(key) is None:
+                row[key] = default
+
+        try:
+            row["datetime_start"] = datetime.fromisoformat(row["datetime_start"])
+            row["datetime_end"] = datetime.fromisoformat(row["datetime_end"])
+        except (TypeError, ValueError):
+            errors.append({"index": index, "message": "Вы пытаетесь добавить некорректное значение даты"})
+            continue
+
+        if any(row.get(key) is not None and row[key] not in list_ids[name] for key, name in SUPERVISION_LISTS.items()):
+            errors.append({"index": index, "message": "Вы пытаетесь добавить некорректное значение списка"})
+            continue
+
+        rows.append(row)
+
+    if errors:
+        return {"errors": sorted(errors, key=lambda error: error["index"])}, 400
+
+    try:
+        with session_scope() as session:
+            artists, artists_inserted = _resolve_artists(session, {row["artist"] for row in rows if row.get("artist")})
+            for row in rows:
+                row["artist_id"] = artists.get(row.pop("artist", None))
+
+            if rows:
+                change_seq = next_change_seq(session)
+                for row in rows:
+                    row["change_seq"] = change_seq
+                session.execute(sqlalchemy.insert(Supervision), rows)
+                months = apply_values(session, rows)
+    except sqlalchemy.exc.IntegrityError:
+        return {"message": "Вы пытаетесь добавить некорректное значение списка"}, 400
+    except sqlalchemy.exc.DataError:
+        return {"message": "Вы пытаетесь добавить некорректное значение даты"}, 400
+
+    _cache_artist_ids(artists)
+    if artists_inserted:
+        invalidate_lists()
+    supervisions_cache.invalidate(months)
+
+    return {"count": len(rows)}, 200
+
+
+def _supervisions_range(my_filter: dict) -> tuple:
+    """Полуинтервал datetime_start по date_start/date_end или year/month фильтра.\n
+    Возвращает ((начало, конец), None) или (None, (сообщение об ошибке, статус))
+    """
     if my_filter.get("date_start") and my_filter.get("date_end"):
         if compare_dates(my_filter["date_start"], my_filter["date_end"]):
-            query.append(Supervision.datetime_start.between(my_filter["date_start"], f'{my_filter["date_end"]} 23:59'))
-        else:
-            return {"message": "Дата начала должна быть меньше либо равна дате конца"}, 400
-    elif my_filter.get("year") and my_filter.get("month"):
-        query.append(Supervision.datetime_start.like(f'{my_filter["year"]:04d}-{my_filter["month"]:02d}%'))
-    else:
-        return {"message": "Не переданы необходимые параметры"}, 400
+            return days_range(my_filter["date_start"], my_filter["date_end"]), None
+        return None, ({"message": "Дата начала должна быть меньше либо равна дате конца"}, 400)
+    if my_filter.get("year") and my_filter.get("month"):
+        try:
+            return month_range(my_filter["year"], my_filter["month"]), None
+        except ValueError:
+            return None, ({"message": "Неверный год или месяц"}, 400)
+    return None, ({"message": "Не переданы необходимые параметры"}, 400)
+
+
+def _supervisions_filter(my_filter: dict) -> tuple:
+    """Условия выборки тех. надзоров по фильтру из TechnicalSupervisions.parser_get.\n
+    Возвращает (список условий, None) или (None, (сообщение об ошибке, статус))
+    """
+    date_range, error = _supervisions_range(my_filter)
+    if error:
+        return None, error
+
+    start, end = date_range
+    query = [Supervision.is_archived == 0]
+    query.append(Supervision.datetime_start >= start)
+    query.append(Supervision.datetime_start < end)
 
     if my_filter.get("contractor_id"):
         query.append(Supervision.contractor_id == my_filter["contractor_id"])
@@ -93,28 +310,280 @@ def get_supervisions(my_filter: dict) -> tuple:
     
     if my_filter.get("status_execution_id"):
         query.append(Supervision.status_execution_id == my_filter["status_execution_id"])
-    
+
+    if my_filter.get("q"):
+        terms = parse_query(my_filter["q"])
+        if not terms:
+            return None, ({"message": "Поисковый запрос не содержит слов для поиска"}, 400)
+        query.append(search_match(terms))
+
+    return query, None
+
+
+def _supervisions_order(my_filter: dict) -> list:
     order = {"id": Supervision.id, "datetime_start": Supervision.datetime_start,
              "datetime_end": Supervision.datetime_end, "station": Supervision.station}
 
-    with session_scope() as session:
-        if my_filter.get("sort_key") and my_filter.get("sort_by"):
-            supervision: Supervision = session.query(Supervision).filter(*query).order_by(order[my_filter["sort_key"]]).all(
-            ) if my_filter["sort_by"] == "ASC" else session.query(Supervision).filter(*query).order_by(desc(order[my_filter["sort_key"]])).all()
+    if my_filter.get("sort_key") and my_filter.get("sort_by"):
+        return [order[my_filter["sort_key"]]] if my_filter["sort_by"] == "ASC" else [desc(order[my_filter["sort_key"]])]
+
+    return []
+
+
+def _supervisions_select(my_filter: dict, query: list) -> Select:
+    """row_select() тех. надзоров по условиям query с сортировкой по sort_key и sort_by.\n
+    Результаты поиска (q) без sort_key упорядочены по убыванию релевантности
+    """
+    if my_filter.get("q") and not my_filter.get("sort_key"):
+        results = search_results(parse_query(my_filter["q"]))
+        return _join_search(results, query).order_by(desc(results.c.relevance), desc(Supervision.id))
+
+    return Supervision.row_select().where(*query).order_by(*_supervisions_order(my_filter))
+
+
+def _join_search(results, query: list) -> Select:
+    """row_select() по условиям query, соединённый с подвыборкой поиска results (её relevance - для сортировки).
+    Соединение само оставляет только найденные тех. надзоры, поэтому условие search_match из query не повторяется
+    """
+    return Supervision.row_select().join(results, results.c.id == Supervision.id) \
+                                   .where(*[condition for condition in query if not isinstance(condition, search_match)])
+
+
+# Параметры parser_get, которые задают диапазон дат: в ключе кэша вместо них сам диапазон
+_RANGE_PARAMS = ("date_start", "date_end", "year", "month")
+
+
+def _cache_key(my_filter: dict, start: datetime, end: datetime) -> tuple:
+    """Ключ supervisions_cache: одинаковый для фильтров, выбирающих одно и то же (например year/month и даты того же месяца)"""
+    params = {name: value for name, value in my_filter.items() if value not in (None, "") and name not in _RANGE_PARAMS and name != "stream"}
+    if "q" in params:
+        params["q"] = parse_query(params["q"])
+    return (start, end, *sorted(params.items()))
+
+
+def get_supervisions(my_filter: dict, choose_encoding=None) -> tuple:
+    """Получение всех тех. надзоров, с фильтрацией (если нужна) и сортировкой.\n
+    Если передан limit - возвращается страница {"items": [...], "next_cursor": ...} (см. _get_supervisions_page).
+    Ответ - готовый JSON из supervisions_cache, при промахе он кодируется здесь и сохраняется в кэше.
+    choose_encoding(размер JSON) - кодировка сжатия ответа или None (compression.choose_encoding для текущего запроса),
+    сжатый вариант тоже хранится в кэше. Возвращает (тело, статус, кодировка тела или None)
+    """
+    query, error = _supervisions_filter(my_filter)
+    if error:
+        return (*error, None)
+
+    (start, end), _ = _supervisions_range(my_filter)
+    key = _cache_key(my_filter, start, end)
+    bodies, generations = supervisions_cache.lookup(key, supervisions_cache.months_between(start, end))
+    if bodies is None:
+        if my_filter.get("limit") is not None:
+            result, status = _get_supervisions_page(my_filter, query)
+            if status != 200:
+                return result, status, None
         else:
-            print(my_filter)
-            supervision: Supervision = session.query(Supervision).filter(*query).all()
-        
-        result = [item.as_dict() for item in supervision]
-    
+            with session_scope() as session:
+                supervisions = read_rows(session, _supervisions_select(my_filter, query)).all()
+
+                serialize = Supervision.row_serializer()
+                result = [serialize(row) for row in supervisions]
+
+        bodies = {None: EncodedJson(dumps(result))}
+        supervisions_cache.store(key, generations, None, bodies[None])
+
+    encoding = choose_encoding(len(bodies[None])) if choose_encoding else None
+    if encoding is not None and encoding not in bodies:
+        bodies[encoding] = compress(bodies[None], encoding)
+        supervisions_cache.store(key, generations, encoding, bodies[encoding])
+    return bodies[encoding], 200, encoding
+
+
+def _keyset_order(my_filter: dict, default_key: str = "id") -> tuple:
+    """Порядок keyset-выборки: (sort_key, колонка, по убыванию ли, подвыборка поиска или None).\n
+    Строки упорядочены по (sort_key, id), без sort_key - по (default_key, id).
+    Результаты поиска (q) без sort_key упорядочены по убыванию релевантности
+    """
+    sort_key = my_filter.get("sort_key") or ("rank" if my_filter.get("q") else default_key)
+    is_desc = my_filter.get("sort_by") == "DESC" or sort_key == "rank"
+    order = {"id": Supervision.id, "datetime_start": Supervision.datetime_start,
+             "datetime_end": Supervision.datetime_end, "station": func.coalesce(Supervision.station, "")}
+    results = None
+    if sort_key == "rank":
+        results = search_results(parse_query(my_filter["q"]))
+        order["rank"] = results.c.relevance
+    return sort_key, order[sort_key], is_desc, results
+
+
+def _keyset_select(my_filter: dict, query: list, after: list, limit: int, default_key: str = "id") -> Select:
+    """row_select() первых limit строк в порядке _keyset_order после строки after = [значение sort_key, id]
+    (after = None - с начала выборки)
+    """
+    sort_key, column, is_desc, results = _keyset_order(my_filter, default_key)
+    conditions = list(query)
+    if after is not None:
+        last_value, last_id = after
+        # отдельное условие на column позволяет выбирать строки диапазоном по индексу, а не проверять OR на каждой строке.
+        # Оно идёт первым: из двух нижних границ datetime_start SQLite берёт для индекса первую
+        if is_desc:
+            conditions = [column <= last_value, or_(column < last_value, and_(column == last_value, Supervision.id < last_id))] + conditions
+        else:
+            conditions = [column >= last_value, or_(column > last_value, and_(column == last_value, Supervision.id > last_id))] + conditions
+
+    order_by = [desc(column), desc(Supervision.id)] if is_desc else [column, Supervision.id]
+    if results is not None:
+        # релевантность нужна для курсора, row_serializer лишнюю последнюю колонку не читает
+        statement = _join_search(results, conditions).add_columns(column.label("rank"))
+    else:
+        statement = Supervision.row_select().where(*conditions)
+    return statement.order_by(*order_by).limit(limit)
+
+
+def _keyset_after(row, sort_key: str) -> list:
+    """[значение sort_key, id] строки - продолжение выборки после неё (см. _keyset_select)"""
+    last_value = getattr(row, sort_key)
+    if sort_key == "station":
+        last_value = last_value or ""
+    return [last_value, row.id]
+
+
+def _supervisions_batches(session: Session, my_filter: dict, query: list, chunk_size: int):
+    """Все строки выборки порциями по chunk_size, каждая порция - отдельный запрос.\n
+    mysqlconnector читает результат запроса в память целиком (stream_results на нём ничего не меняет),
+    поэтому большая выборка не читается одним запросом.
+    - без sort_key и q строки идут по (datetime_start, id), в порядке индекса ix_supervisions_archived_start:
+      порция - следующие chunk_size строк после последней прочитанной (_keyset_select)
+    - с sort_key или q так пришлось бы сортировать (и искать) весь диапазон заново для каждой порции, поэтому
+      сначала одним запросом читаются только id в нужном порядке, затем строки - порциями по chunk_size id
+    """
+    sort_key = _keyset_order(my_filter, "datetime_start")[0]
+    if sort_key != "datetime_start" or my_filter.get("q"):
+        statement = _keyset_select(my_filter, query, None, None, "datetime_start").with_only_columns(Supervision.id)
+        ids = [supervision_id for supervision_id, in read_rows(session, statement)]
+        for chunk in chunks(ids, chunk_size):
+            rows = {row.id: row for row in read_rows(session, Supervision.row_select().where(Supervision.id.in_(chunk)))}
+            yield [rows[supervision_id] for supervision_id in chunk if supervision_id in rows]
+        return
+
+    after = None
+    while True:
+        rows = read_rows(session, _keyset_select(my_filter, query, after, chunk_size, "datetime_start")).all()
+        if rows:
+            yield rows
+        if len(rows) < chunk_size:
+            return
+        after = _keyset_after(rows[-1], sort_key)
+
+
+def _is_int(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _cursor_value(sort_key: str, value):
+    """Значение sort_key из курсора в типе колонки или None, если тип не подходит (значение попадает в SQL как есть)"""
+    if sort_key in ("datetime_start", "datetime_end"):
+        try:
+            return datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            return None
+    if sort_key == "id":
+        return value if _is_int(value) else None
+    if sort_key == "station":
+        return value if isinstance(value, str) else None
+    return float(value) if _is_int(value) or isinstance(value, float) else None
+
+
+def _get_supervisions_page(my_filter: dict, query: list) -> tuple:
+    """Постраничная (keyset) выборка тех. надзоров.\n
+    Строки упорядочены по (sort_key, id), курсор хранит значения этой пары у последней строки страницы,
+    поэтому следующая страница выбирается условием "после курсора", а не OFFSET.
+    Результаты поиска (q) без sort_key упорядочены по убыванию релевантности.
+    next_cursor = None - страниц больше нет
+    """
+    if my_filter["limit"] < 1:
+        return {"message": "limit должен быть больше 0"}, 400
+
+    sort_key = _keyset_order(my_filter)[0]
+    after = None
+    if my_filter.get("cursor"):
+        after = decode_cursor(my_filter["cursor"])
+        if after is None:
+            return {"message": "Неверный курсор"}, 400
+
+        after = [_cursor_value(sort_key, after[0]), after[1]]
+        if after[0] is None or not _is_int(after[1]):
+            return {"message": "Неверный курсор"}, 400
+
+    with session_scope() as session:
+        supervisions = read_rows(session, _keyset_select(my_filter, query, after, my_filter["limit"] + 1)).all()
+
+        next_cursor = None
+        if len(supervisions) > my_filter["limit"]:
+            supervisions = supervisions[:my_filter["limit"]]
+            next_cursor = encode_cursor(_keyset_after(supervisions[-1], sort_key))
+
+        serialize = Supervision.row_serializer()
+        result = {"items": [serialize(row) for row in supervisions], "next_cursor": next_cursor}
+
     return result, 200
 
 
+def stream_supervisions(my_filter: dict, chunk_size: int = 500) -> tuple:
+    """Потоковая выборка тех. надзоров для больших диапазонов дат.\n
+    Возвращает (генератор списков словарей по chunk_size строк, 200) или (сообщение об ошибке, статус).
+    Строки читаются порциями по chunk_size (_supervisions_batches), поэтому вся выборка никогда не находится в памяти целиком
+    """
+    query, error = _supervisions_filter(my_filter)
+    if error:
+        return error
+
+    def generate():
+        with session_scope() as session:
+            serialize = Supervision.row_serializer()
+            for rows in _supervisions_batches(session, my_filter, query, chunk_size):
+                yield [serialize(row) for row in rows]
+
+    return generate(), 200
+
+
 def get_single_supervision(supervision_id: int) -> tuple:
     """Получение информации по конкретному тех.надзору"""
     with session_scope() as session:
-        supervision: Supervision = session.query(Supervision).get(supervision_id)
-        return (supervision.as_dict(), 200) if supervision else ({"message": f"Тех. надзор с id = {supervision_id} не найден"}, 400)
+        supervision = read_rows(session, Supervision.row_select().where(Supervision.id == supervision_id)).one_or_none()
+        return (Supervision.row_serializer()(supervision), 200) if supervision else ({"message": f"Тех. надзор с id = {supervision_id} не найден"}, 400)
+
+
+def get_supervision_changes(since: str = None, limit: int = 1000) -> tuple:
+    """Тех. надзоры, изменённые после since, в порядке изменения (change_seq, id), включая архивированные.\n
+    - since - токен из предыдущего ответа; без него возвращается только токен текущего состояния
+    - ответ {"items": [...], "since": токен для следующего запроса, "has_more": есть ли ещё изменения}
+    """
+    if limit < 1:
+        return {"message": "limit должен быть больше 0"}, 400
+
+    if not since:
+        with session_scope() as session:
+            return {"items": [], "since": encode_cursor([current_change_seq(session), None]), "has_more": False}, 200
+
+    cursor = decode_cursor(since)
+    if not cursor or not isinstance(cursor[0], int) or not (cursor[1] is None or isinstance(cursor[1], int)):
+        return {"message": "Неверный since"}, 400
+
+    change_seq, last_id = cursor
+    if last_id is None:
+        condition = Supervision.change_seq > change_seq
+    else:
+        condition = or_(Supervision.change_seq > change_seq, and_(Supervision.change_seq == change_seq, Supervision.id > last_id))
+    statement = Supervision.row_select().where(condition).order_by(Supervision.change_seq, Supervision.id).limit(limit + 1)
+
+    with session_scope() as session:
+        supervisions = read_rows(session, statement).all()
+
+    has_more = len(supervisions) > limit
+    supervisions = supervisions[:limit]
+    if supervisions:
+        since = encode_cursor([supervisions[-1].change_seq, supervisions[-1].id])
+
+    serialize = Supervision.row_serializer()
+    return {"items": [serialize(row) for row in supervisions], "since": since, "has_more": has_more}, 200
 
 
 def change_supervision(supervision_id: int, kwargs: dict) -> tuple:
@@ -129,137 +598,189 @@ def change_supervision(supervision_id: int, kwargs: dict) -> tuple:
 
     try:
         with session_scope() as session:
-            supervision: Supervision = session.query(Supervision).filter(Supervision.id == supervision_id).update(kwargs, synchronize_session='fetch')
+            kwargs["change_seq"] = next_change_seq(session)
+            months = apply_supervisions(session, [supervision_id], -1)
+            kwargs["version"] = Supervision.version + 1
+            supervision: Supervision = session.query(Supervision).filter(Supervision.id == supervision_id).update(kwargs, synchronize_session=False)
             if not supervision:
                 return {"message": "Вы пытаетесь изменить несуществующий тех. надзор"}, 400
 
+            months |= apply_supervisions(session, [supervision_id], 1)
+
     except sqlalchemy.exc.IntegrityError:
         return {"message": "Вы пытаетесь добавить некорректное значение списка"}, 400
     except sqlalchemy.exc.DataError:
         return {"message": "Вы пытаетесь добавить некорректное значение даты"}, 400
 
+    supervisions_cache.invalidate(months)
     return None, 200
 
 
+# Поля, от которых зависят счётчики supervision_monthly_stats
+STATS_FIELDS = ("datetime_start", "status_execution_id", "status_ks_id")
+
+
+def _check_version(session: Session, supervision_id: int, version: int) -> tuple:
+    """({"version": version}, 200), если у тех. надзора версия version, иначе сообщение и 400 (тех. надзора нет) или 409"""
+    current_version = session.query(Supervision.version).filter(Supervision.id == supervision_id).scalar()
+    if current_version is None:
+        return {"message": "Вы пытаетесь изменить несуществующий тех. надзор"}, 400
+    if current_version != version:
+        return {"message": "Тех. надзор уже изменён другим пользователем", "version": current_version}, 409
+    return {"version": version}, 200
+
+
+def patch_supervision(supervision_id: int, version: int, fields: dict) -> tuple:
+    """Частичное изменение тех. надзора с оптимистичной блокировкой.\n
+    Записываются только переданные поля, UPDATE выполняется при условии version = переданной версии.
+    Если строку уже изменили - 409 и текущая версия. Возвращает новую версию
+    """
+    fields = general_filter(fields)
+    if "artist" in fields:
+        fields["artist_id"] = create_new_artist(fields["artist"]) if fields["artist"] else None
+        fields.pop("artist")
+
+    if not fields:
+        # изменять нечего, но ответ должен быть тем же, что и при изменении: 400 для несуществующего тех. надзора, 409 для устаревшей версии
+        with session_scope() as session:
+            return _check_version(session, supervision_id, version)
+
+    fields["version"] = Supervision.version + 1
+    affects_stats = any(key in fields for key in STATS_FIELDS)
+    try:
+        with session_scope() as session:
+            fields["change_seq"] = next_change_seq(session)
+            if affects_stats:
+                months = apply_supervisions(session, [supervision_id], -1)
+
+            updated = session.query(Supervision).filter(Supervision.id == supervision_id, Supervision.version == version) \
+                                                .update(fields, synchronize_session=False)
+            if not updated:
+                session.rollback()
+                return _check_version(session, supervision_id, version)
+
+            if affects_stats:
+                months |= apply_supervisions(session, [supervision_id], 1)
+            else:
+                # месяц тех. надзора не изменился, счётчики не пересчитываются
+                months = {(int(year), int(month)) for year, month, *_ in count_by_month(session, Supervision.id == supervision_id)}
+
+    except sqlalchemy.exc.IntegrityError:
+        return {"message": "Вы пытаетесь добавить некорректное значение списка"}, 400
+    except sqlalchemy.exc.DataError:
+        return {"message": "Вы пытаетесь добавить некорректное значение даты"}, 400
+
+    supervisions_cache.invalidate(months)
+    return {"version": version + 1}, 200
+
+
 def delete_supervision(supervision_id: int) -> tuple:
     """Удаление (архивирование) конкретного тех. надзора"""
 
     with session_scope() as session:
+        change_seq = next_change_seq(session)
+        months = apply_supervisions(session, [supervision_id], -1)
         supervision: Supervision = session.query(Supervision).get(supervision_id)
         supervision.is_archived = 1
+        supervision.version = Supervision.version + 1
+        supervision.change_seq = change_seq
 
+    supervisions_cache.invalidate(months)
     return None, 200
 
 
-def excel_load(supervision_ids: list, load_type: str) -> BytesIO:
+def count_supervisions(my_filter: dict) -> tuple:
+    """Количество тех. надзоров, подходящих под фильтр TechnicalSupervisions.parser_get"""
+    query, error = _supervisions_filter(my_filter)
+    if error:
+        return error
+
     with session_scope() as session:
-        supervisions = session.query(Supervision).filter(Supervision.id.in_(supervision_ids)).all()
-
-        wb = openpyxl.Workbook()
-        wb.create_sheet(title=f"Выгрузка", index=0)
-        sheet = wb[f"Выгрузка"]
-        
-        # стили для текста
-        alignCenter_wrapText = Alignment(horizontal='center', vertical='center', wrap_text=True)
-        wrap_text = Alignment(wrap_text=True)
-        font14_bold = Font(size=14, bold=True)
-        font14 = Font(size=14, bold=False)
-        font22 = Font(size=22, bold=True)
-        
-        sheet['A1'] = 'План работы МТК'
-        if load_type == "outside":
-            sheet.merge_cells('A1:M1')
-            sheet.append(["№ п/п", "Дата, время начала работ", "Дата, время окончания работ",
-                          "Время, всего", "Станция (место проведения работ)", "Отдел, Дистанция", "Ф. И. О. осуществляющего технический надзор", 
-                          "Вид проводимой работы (объем произведенной работы)", "Название сторонней организации", 
-                          "Фамилия, Имя, телефон производителя", "Номер совместного приказа", "Примечание", "Подпись работника"])
-
-            for index, row in enumerate(supervisions, 1):
-                row = row.as_dict()
-                sheet.append([index, datetime.strptime(row["datetime_start"], '%Y-%m-%d %H:%M').strftime('%d.%m.%Y %H:%M'), 
-                              datetime.strptime(row["datetime_end"], '%Y-%m-%d %H:%M').strftime('%d.%m.%Y %H:%M'), 
-                              hours_between_dates(row["datetime_start"], row["datetime_end"]),
-                              row["station"], row["department_distance"], row["artist"], row["type_work"], 
-                              'test', row["manufacturer_info"],
-                              row["order_number"], row["note"], ""])
-        
-        elif load_type == "inside":
-            sheet.merge_cells('A1:N1')
-            sheet.append(["№ п/п", "Дата, время начала работ", "Дата, время окончания работ",
-                          "Время, всего", "Станция (место проведения работ)", "Отдел, Дистанция", "Ф. И. О. осуществляющего технический надзор", 
-                          "Вид проводимой работы (объем произведенной работы)", "Название сторонней организации", 
-                          "Фамилия, Имя, телефон производителя", "Номер совместного приказа", "Примечание", "Подпись работника", "Ответственное подразделение"])
-
-            for index, row in enumerate(supervisions, 1):
-                row = row.as_dict()
-                sheet.append([index, datetime.strptime(row["datetime_start"], '%Y-%m-%d %H:%M').strftime('%d.%m.%Y %H:%M'), 
-                              datetime.strptime(row["datetime_end"], '%Y-%m-%d %H:%M').strftime('%d.%m.%Y %H:%M'), 
-                              hours_between_dates(row["datetime_start"], row["datetime_end"]),
-                              row["station"], row["department_distance"], row["artist"], row["type_work"], 
-                              'test', row["manufacturer_info"],
-                              row["order_number"], row["note"], "", row["department_responsible"]])
-
-
-        for column in sheet.columns:
-            for cell in column:
-                cell.font = font14
-                cell.alignment = wrap_text
-            
-            column[1].font = font14_bold
-            column[1].alignment = alignCenter_wrapText
-
-        sheet['A1'].alignment = alignCenter_wrapText
-        sheet['A1'].font = font22
-        sheet.row_dimensions[1].height = 80
-
-        sheet.column_dimensions['A'].width = 17
-        sheet.column_dimensions['B'].width = 23
-        sheet.column_dimensions['C'].width = 23
-        sheet.column_dimensions['D'].width = 20
-        sheet.column_dimensions['E'].width = 50
-        sheet.column_dimensions['F'].width = 14
-        sheet.column_dimensions['G'].width = 22
-        sheet.column_dimensions['H'].width = 53
-        sheet.column_dimensions['I'].width = 31
-        sheet.column_dimensions['J'].width = 27
-        sheet.column_dimensions['K'].width = 36
-        sheet.column_dimensions['L'].width = 60
-        sheet.column_dimensions['M'].width = 20
-        sheet.column_dimensions['N'].width = 20
-
-        bytes_book = BytesIO()
-        wb.save(bytes_book)
-        wb.close()
-        bytes_book.seek(0)
-
-        return bytes_book
-
-
-def take_in_ks(take_in_ks_ids: list, not_take_in_ks_ids: list) -> tuple:
+        return session.query(func.count(Supervision.id)).filter(*query).scalar(), 200
+
+
+def excel_load(load_type: str, supervision_ids: list = None, my_filter: dict = None, output=None, progress=None, chunk_size: int = 500) -> tuple:
+    """Выгрузка тех. надзоров в Excel. Возвращает (файл, 200) или (сообщение об ошибке, статус).\n
+    - supervision_ids - явный список id, выбирается порциями по chunk_size id, чтобы не строить огромный IN
+    - my_filter - фильтр как у TechnicalSupervisions.parser_get (если supervision_ids не передан), строки читаются порциями по chunk_size (_supervisions_batches)
+    - output - файл для записи (см. write_workbook)
+    - progress - функция, которая вызывается с количеством уже записанных строк
+    """
+    if supervision_ids is None:
+        query, error = _supervisions_filter(my_filter)
+        if error:
+            return error
+
+    def by_ids(session):
+        for ids in chunks(supervision_ids, chunk_size):
+            yield from read_rows(session, Supervision.row_select().where(Supervision.id.in_(ids)))
+
+    def by_filter(session):
+        for rows in _supervisions_batches(session, my_filter, query, chunk_size):
+            yield from rows
+
+    serialize = Supervision.row_serializer()
+
+    def rows(supervisions):
+        for count, row in enumerate(supervisions, 1):
+            yield serialize(row)
+            if progress and count % chunk_size == 0:
+                progress(count)
+
     with session_scope() as session:
-        if take_in_ks_ids:
-            session.query(Supervision).filter(Supervision.id.in_(take_in_ks_ids)).update({"status_ks_id": 1}, synchronize_session='fetch')
-        
-        if not_take_in_ks_ids:
-            session.query(Supervision).filter(Supervision.id.in_(not_take_in_ks_ids)).update({"status_ks_id": 2, "comment": None}, synchronize_session='fetch')
-    
-    return None, 200
+        supervisions = by_ids(session) if supervision_ids is not None else by_filter(session)
+        return write_workbook(rows(supervisions), load_type, output), 200
+
+
+def take_in_ks(take_in_ks_ids: list, not_take_in_ks_ids: list, comments: dict = None, chunk_size: int = 500) -> tuple:
+    """Учесть (take_in_ks_ids) или не учесть (not_take_in_ks_ids) тех. надзоры в КС одной транзакцией.\n
+    - comments - {id: комментарий} для учитываемых тех. надзоров, у остальных учитываемых комментарий не меняется
+    - id обрабатываются UPDATE-ами по chunk_size штук без синхронизации сессии
+
+    Возвращает количество изменённых и не найденных тех. надзоров
+    """
+    try:
+        comments = {int(supervision_id): comment for supervision_id, comment in (comments or {}).items()}
+    except ValueError:
+        return {"message": "Ключи comments должны быть id тех. надзоров"}, 400
+
+    not_take_in_ks_ids = list(dict.fromkeys(not_take_in_ks_ids or []))
+    # id из обоих списков не учитывается в КС (как и раньше, когда второй UPDATE перезаписывал первый).
+    # Так каждый id в changed_ids встречается один раз и не вычитается из счётчиков дважды
+    excluded = set(not_take_in_ks_ids)
+    take_in_ks_ids = [supervision_id for supervision_id in dict.fromkeys(take_in_ks_ids or []) if supervision_id not in excluded]
+    changed_ids = take_in_ks_ids + not_take_in_ks_ids
+    updated = 0
+    with session_scope() as session:
+        change_seq = next_change_seq(session)
+        months = apply_supervisions(session, changed_ids, -1)
+        for ids in chunks(take_in_ks_ids, chunk_size):
+            values = {"status_ks_id": 1, "version": Supervision.version + 1, "change_seq": change_seq}
+            chunk_comments = {supervision_id: comments[supervision_id] for supervision_id in ids if supervision_id in comments}
+            if chunk_comments:
+                values["comment"] = case(chunk_comments, value=Supervision.id, else_=Supervision.comment)
+            updated += session.query(Supervision).filter(Supervision.id.in_(ids)).update(values, synchronize_session=False)
+
+        for ids in chunks(not_take_in_ks_ids, chunk_size):
+            updated += session.query(Supervision).filter(Supervision.id.in_(ids)).update({"status_ks_id": 2, "comment": None, "version": Supervision.version + 1, "change_seq": change_seq}, synchronize_session=False)
+
+        months |= apply_supervisions(session, changed_ids, 1)
+
+    supervisions_cache.invalidate(months)
+    return {"updated": updated, "not_found": len(changed_ids) - updated}, 200
 
 
 def supervisions_count_info(year: int) -> tuple:
-    months = ("01", "02", "03", "04", "05", "06", "07", "08", "09", "10", "11", "12")
+    """Количественная информация о тех. надзорах за год (всего, выполнено, учтено в КС) с разбивкой по месяцам.\n
+    Счётчики читаются из supervision_monthly_stats (не более 12 строк), итоги за год складываются из месячных строк
+    """
+    count_months = {f"{month_num:02d}": {"all_count": 0, "completed": 0, "take_in_ks": 0} for month_num in range(1, 13)}
     with session_scope() as session:
-        all_count = session.query(Supervision).filter(Supervision.is_archived == 0, Supervision.datetime_start.like(f"{year}%")).count()
-        completed = session.query(Supervision).filter(Supervision.is_archived == 0, Supervision.datetime_start.like(f"{year}%"), Supervision.status_execution_id == 2).count()
-        take_in_ks = session.query(Supervision).filter(Supervision.is_archived == 0, Supervision.datetime_start.like(f"{year}%"), Supervision.status_ks_id == 1).count()
-        
-        count_months = {}
-        for month_num in months:
-            count_months[month_num] = {
-                "all_count": session.query(Supervision).filter(Supervision.is_archived == 0, Supervision.datetime_start.like(f"{year}-{month_num}%")).count(),
-                "completed": session.query(Supervision).filter(Supervision.is_archived == 0, Supervision.datetime_start.like(f"{year}-{month_num}%"), Supervision.status_execution_id == 2).count(),
-                "take_in_ks": session.query(Supervision).filter(Supervision.is_archived == 0, Supervision.datetime_start.like(f"{year}-{month_num}%"), Supervision.status_ks_id == 1).count()
-            }
+        for item in get_year_stats(session, year):
+            count_months[f"{item.month:02d}"] = {"all_count": item.all_count, "completed": item.completed, "take_in_ks": item.take_in_ks}
+
+    all_count = sum(item["all_count"] for item in count_months.values())
+    completed = sum(item["completed"] for item in count_months.values())
+    take_in_ks = sum(item["take_in_ks"] for item in count_months.values())
 
-    
     return {"all_count": all_count, "completed": completed, "take_in_ks": take_in_ks, "count_months": count_months}, 200
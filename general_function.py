@@ -1,4 +1,6 @@
-from datetime import datetime
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime, timedelta
+import json
 
 
 def general_filter(params: dict) -> dict:
@@ -20,10 +22,43 @@ def compare_dates(date_start, date_end):
         return False
 
 
+def month_range(year: int, month: int) -> tuple:
+    """функция которая возвращает полуинтервал [начало месяца, начало следующего месяца) для фильтрации по дате без LIKE"""
+    start = datetime(year, month, 1)
+    end = datetime(year + 1, 1, 1) if month == 12 else datetime(year, month + 1, 1)
+    return start, end
+
+
+def days_range(date_start: str, date_end: str) -> tuple:
+    """функция которая возвращает полуинтервал [date_start, день после date_end) по датам вида YYYY-MM-DD"""
+    start = datetime.strptime(date_start, '%Y-%m-%d')
+    end = datetime.strptime(date_end, '%Y-%m-%d') + timedelta(days=1)
+    return start, end
+
+
 def hours_between_dates(datetime_start, datetime_end):
     date_format = '%Y-%m-%d %H:%M'
     datetime_start = datetime.strptime(datetime_start, date_format)
     datetime_end = datetime.strptime(datetime_end, date_format)
     delta = datetime_end - datetime_start
     hours = delta.total_seconds() / 3600
-    return round(hours)
\ No newline at end of file
+    return round(hours)
+
+def chunks(items: list, size: int):
+    """функция которая делит список на части не длиннее size (для IN-запросов по большим спискам id)"""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def encode_cursor(values: list) -> str:
+    """функция которая упаковывает значения ключа последней строки страницы в непрозрачный курсор"""
+    return urlsafe_b64encode(json.dumps(values, default=str).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> list:
+    """функция обратная encode_cursor. Возвращает None, если курсор повреждён"""
+    try:
+        values = json.loads(urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        return None
+    return values if isinstance(values, list) and len(values) == 2 else None
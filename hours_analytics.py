@@ -0,0 +1,86 @@
+"""Часы работ по тех. надзорам за год (или месяц) с разбивкой по месяцам и подрядчикам, подразделениям, исполнителям или типам дней.
+
+Длительность и суммы считаются в БД (TIMESTAMPDIFF в MySQL), в Python приходит по одной строке на группу и месяц.
+Строки выбираются тем же условием, что и списки тех. надзоров (is_archived, диапазон datetime_start),
+поэтому запрос использует индекс ix_supervisions_archived_start
+"""
+from sqlalchemy import Integer, extract, func, select
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+from functions import read_rows
+from general_function import month_range
+from models import Supervision
+from my_engine import session_scope
+
+# group_by -> ключ Supervision.__dict_lookups__ (relationship и колонка названия в справочнике)
+GROUPS = ("contractor", "department_responsible", "artist", "day_type")
+
+
+class minutes_between(FunctionElement):
+    """Целое число минут между двумя датами (конец - начало)"""
+    type = Integer()
+    name = "minutes_between"
+    inherit_cache = True
+
+
+@compiles(minutes_between, "mysql")
+def _mysql_minutes_between(element, compiler, **kw):
+    start, end = element.clauses
+    return f"TIMESTAMPDIFF(MINUTE, {compiler.process(start, **kw)}, {compiler.process(end, **kw)})"
+
+
+@compiles(minutes_between, "sqlite")
+def _sqlite_minutes_between(element, compiler, **kw):
+    start, end = element.clauses
+    return f"CAST(round((julianday({compiler.process(end, **kw)}) - julianday({compiler.process(start, **kw)})) * 1440) AS INTEGER)"
+
+
+def _hours_query(group_by: str, start, end):
+    """(id группы, название, месяц, количество тех. надзоров, сумма минут) по неархивным тех. надзорам из [start, end)"""
+    relationship, column = Supervision.__dict_lookups__[group_by]
+    prop = getattr(Supervision, relationship).property
+    group_id = next(iter(prop.local_columns))
+    name = prop.mapper.local_table.c[column]
+    month = extract("month", Supervision.datetime_start)
+    return select(group_id, name, month, func.count(Supervision.id), func.sum(minutes_between(Supervision.datetime_start, Supervision.datetime_end))) \
+        .select_from(Supervision.__table__.outerjoin(prop.mapper.local_table, prop.primaryjoin)) \
+        .where(Supervision.is_archived == 0, Supervision.datetime_start >= start, Supervision.datetime_start < end) \
+        .group_by(group_id, name, month)
+
+
+def get_hours_analytics(year: int, group_by: str, month: int = None) -> tuple:
+    """Сводная таблица часов: строка на каждое значение group_by, колонки - месяцы.\n
+    Ответ вида {"months": [1, ..., 12], "rows": [{"id", "name", "count": [...], "hours": [...], "total_count", "total_hours"}], "total": {...}}.
+    count и hours - списки по месяцам из months; тех. надзоры без подрядчика или исполнителя попадают в строку с id = None
+    """
+    if group_by not in GROUPS:
+        return {"message": f"group_by должен быть одним из: {', '.join(GROUPS)}"}, 400
+
+    try:
+        if month:
+            start, end = month_range(year, month)
+            months = [month]
+        else:
+            start, end = month_range(year, 1)[0], month_range(year, 12)[1]
+            months = list(range(1, 13))
+    except ValueError:
+        return {"message": "Неверный год или месяц"}, 400
+
+    column = {item: index for index, item in enumerate(months)}
+    groups = {}
+    with session_scope() as session:
+        for group_id, name, row_month, count, minutes in read_rows(session, _hours_query(group_by, start, end)):
+            group = groups.setdefault(group_id, {"id": group_id, "name": name, "count": [0] * len(months), "minutes": [0] * len(months)})
+            group["count"][column[int(row_month)]] = count
+            group["minutes"][column[int(row_month)]] = int(minutes or 0)
+
+    def totals(item: dict) -> dict:
+        return {"count": item["count"], "hours": [round(minutes / 60, 2) for minutes in item["minutes"]],
+                "total_count": sum(item["count"]), "total_hours": round(sum(item["minutes"]) / 60, 2)}
+
+    rows = [{"id": group["id"], "name": group["name"], **totals(group)} for group in groups.values()]
+    rows.sort(key=lambda row: row["total_hours"], reverse=True)
+    total = totals({"count": [sum(group["count"][index] for group in groups.values()) for index in range(len(months))],
+                    "minutes": [sum(group["minutes"][index] for group in groups.values()) for index in range(len(months))]})
+
+    return {"year": year, "group_by": group_by, "months": months, "rows": rows, "total": total}, 200
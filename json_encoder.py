@@ -0,0 +1,40 @@
+from datetime import date, datetime
+from decimal import Decimal
+import json
+
+try:
+    import orjson
+except ImportError:  # orjson необязателен, без него работает стандартный json
+    orjson = None
+
+
+def _default(value):
+    """Типы, которые не кодируются бэкендом сам: даты (для json) и Decimal из агрегатов MySQL"""
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class EncodedJson(bytes):
+    """Уже закодированный JSON (например ответ из кэша): dumps возвращает его как есть"""
+
+
+if orjson is not None:
+    BACKEND = "orjson"
+
+    def dumps(body) -> bytes:
+        """Кодирует body в JSON (UTF-8 байты без экранирования не-ASCII символов). Даты - в ISO 8601"""
+        if isinstance(body, EncodedJson):
+            return body
+        return orjson.dumps(body, default=_default, option=orjson.OPT_NON_STR_KEYS)
+else:
+    BACKEND = "json"
+    _encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"), default=_default)
+
+    def dumps(body) -> bytes:
+        """Кодирует body в JSON (UTF-8 байты без экранирования не-ASCII символов). Даты - в ISO 8601"""
+        if isinstance(body, EncodedJson):
+            return body
+        return _encoder.encode(body).encode()
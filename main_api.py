@@ -1,13 +1,19 @@
 from datetime import datetime, timedelta, timezone
+import logging
 from waitress import serve
-from flask import Flask, Response, json, send_file
-from flask_restful import Api, Resource, reqparse
+from flask import Flask, Response, request, send_file, stream_with_context
+from flask_restful import Api, Resource, inputs, reqparse
 from config import API, SECRET_KEY
 from flask.wrappers import Request
 from flask_jwt_extended import (JWTManager, create_access_token, get_jwt,
                                 get_jwt_identity, jwt_required,
                                 set_access_cookies, unset_jwt_cookies)
-from functions import add_supervision, authorization, change_supervision, delete_supervision, excel_load, get_lists, get_single_supervision, get_supervisions, supervisions_count_info, take_in_ks
+from compression import CompressedCache, choose_encoding, compress_response
+from export_jobs import get_export_file, get_export_status, start_export
+from functions import add_supervision, add_supervisions, authorization, change_supervision, delete_supervision, excel_load, get_lists, get_single_supervision, get_supervision_changes, get_supervisions, health, patch_supervision, stream_supervisions, supervisions_count_info, take_in_ks, warm_artists
+from hours_analytics import GROUPS, get_hours_analytics
+from json_encoder import EncodedJson, dumps
+from metrics import METRICS_HOSTS, init_metrics, render_metrics
 
 
 class AnyJsonRequest(Request):
@@ -32,6 +38,12 @@ app.config["JWT_ACCESS_TOKEN_EXPIRES"] = timedelta(days=30)
 
 api = Api(app, prefix="")
 jwt = JWTManager(app)
+init_metrics(app)
+
+
+@app.after_request
+def compress(response):
+    return compress_response(request, response)
 
 
 class _Resource(Resource):
@@ -40,11 +52,48 @@ class _Resource(Resource):
 
     def return_json(self, body, status):
         return Response(
-            json.dumps(body, ensure_ascii=False),
+            dumps(body),
             mimetype="application/json",
             status=status,
         )
 
+    def return_json_cached(self, body, status, cache: CompressedCache, key: str):
+        """return_json для содержимого, неизменного при том же key: JSON и его сжатый вариант строятся один раз на key"""
+        def encode():
+            return EncodedJson(dumps(body))
+
+        data = cache.get(key, None, encode)
+        encoding = choose_encoding(request, len(data))
+        return self.return_json_encoded(cache.get(key, encoding, encode) if encoding else data, status, encoding)
+
+    def return_json_encoded(self, body, status, encoding):
+        """Ответ с готовым телом: JSON (encoding = None) или уже сжатый в кодировке encoding, after_request его повторно не сжимает"""
+        if encoding is None:
+            return self.return_json(body, status)
+
+        response = Response(body, mimetype="application/json", status=status)
+        response.headers["Content-Encoding"] = encoding
+        response.vary.add("Accept-Encoding")
+        return response
+
+    def return_json_stream(self, body, status):
+        """body - генератор списков, ответ отдаётся JSON-массивом по частям, не собирая его в памяти целиком"""
+        if status != 200:
+            return self.return_json(body, status)
+
+        def generate():
+            yield b"["
+            first = True
+            for chunk in body:
+                # чанк кодируется целиком и срезаются его скобки - один вызов кодировщика на чанк
+                encoded = dumps(chunk)[1:-1]
+                if encoded:
+                    yield encoded if first else b"," + encoded
+                    first = False
+            yield b"]"
+
+        return Response(stream_with_context(generate()), mimetype="application/json", status=status)
+
     def return_status(self, status):
         return Response(status=status)
 
@@ -94,8 +143,41 @@ class TechnicalSupervisions(_Resource):
     parser_get.add_argument('status_execution_id', type=int)
     parser_get.add_argument('year', type=int)
     parser_get.add_argument('month', type=int)
+    parser_get.add_argument('q', type=str) # поиск по станции, виду работ, примечанию и производителю, без sort_key - по релевантности
     parser_get.add_argument('sort_key', type=str, choices=("id", 'datetime_start', 'datetime_end', 'station'))
     parser_get.add_argument('sort_by', type=str, choices=('ASC', 'DESC'), help='Неверный вид сортировки') # DESC - убывание, ASC - возрастание
+    parser_get.add_argument('limit', type=int) # размер страницы, ответ будет вида {"items": [...], "next_cursor": ...}
+    parser_get.add_argument('cursor', type=str) # next_cursor из предыдущей страницы
+    parser_get.add_argument('stream', type=inputs.boolean, default=False) # отдать весь результат потоком
+
+    @classmethod
+    def parse_fields(cls, item, partial: bool = False) -> dict:
+        """Разбор словаря (например элемента JSON-массива) по правилам parser. При ошибке бросает ValueError.\n
+        partial=True - разбираются только переданные поля, обязательность не проверяется
+        """
+        if not isinstance(item, dict):
+            raise ValueError("Элемент должен быть объектом")
+
+        result = {}
+        for argument in cls.parser.args:
+            if partial and argument.name not in item:
+                continue
+
+            value = item.get(argument.name)
+            if isinstance(value, str):
+                value = value.strip()
+            if value is None:
+                if argument.required and not partial:
+                    raise ValueError(f"Не передан параметр {argument.name}")
+                result[argument.name] = None
+                continue
+
+            try:
+                result[argument.name] = argument.type(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"Некорректное значение параметра {argument.name}")
+
+        return result
 
     @jwt_required()
     def get(self, supervision_id=None):
@@ -107,7 +189,9 @@ class TechnicalSupervisions(_Resource):
             return self.return_json(*get_single_supervision(supervision_id))
         else:
             args: dict = self.parser_get.parse_args()
-            return self.return_json(*get_supervisions(args))
+            if args["stream"]:
+                return self.return_json_stream(*stream_supervisions(args))
+            return self.return_json_encoded(*get_supervisions(args, lambda size: choose_encoding(request, size)))
 
     @jwt_required()
     def post(self):
@@ -121,36 +205,158 @@ class TechnicalSupervisions(_Resource):
         args: dict = self.parser.parse_args()
         return self.return_json(*change_supervision(supervision_id, args))
 
+    @jwt_required()
+    def patch(self, supervision_id):
+        """Частичное изменение тех. надзора.\n
+        Тело - JSON только с изменёнными полями и version, полученной вместе с тех. надзором.
+        Если тех. надзор уже изменили после получения version, возвращается 409
+        """
+        body = request.get_json(silent=True)
+        # bool - подкласс int, но true/false версией не являются
+        if not isinstance(body, dict) or not isinstance(body.get("version"), int) or isinstance(body["version"], bool):
+            return self.return_json({"message": "Не передана версия тех. надзора"}, 400)
+
+        try:
+            fields = self.parse_fields(body, partial=True)
+        except ValueError as e:
+            return self.return_json({"message": str(e)}, 400)
+
+        return self.return_json(*patch_supervision(supervision_id, body["version"], fields))
+
     @jwt_required()
     def delete(self, supervision_id):
         """изменение конкретного тех. надзора"""
         return self.return_json(*delete_supervision(supervision_id))
 
 
+class TechnicalSupervisionsBatch(_Resource):
+    """Пакетное добавление тех. надзоров"""
+
+    @jwt_required()
+    def post(self):
+        """Тело запроса - JSON-массив объектов с теми же полями, что у POST /supervisions"""
+        body = request.get_json(silent=True)
+        if not isinstance(body, list):
+            return self.return_json({"message": "Ожидается массив тех. надзоров"}, 400)
+
+        items, errors = [], []
+        for index, item in enumerate(body):
+            try:
+                items.append(TechnicalSupervisions.parse_fields(item))
+            except ValueError as e:
+                items.append(None)
+                errors.append({"index": index, "message": str(e)})
+
+        return self.return_json(*add_supervisions(items, errors))
+
+
+class TechnicalSupervisionsChanges(_Resource):
+    """Тех. надзоры, изменённые после предыдущего запроса (в том числе архивированные), для синхронизации клиентов"""
+    parser = reqparse.RequestParser(trim=True)
+    parser.add_argument('since', type=str) # since из предыдущего ответа, без него - только since текущего состояния
+    parser.add_argument('limit', type=int, default=1000)
+
+    @jwt_required()
+    def get(self):
+        args: dict = self.parser.parse_args()
+        return self.return_json(*get_supervision_changes(args["since"], args["limit"]))
+
+
 class Lists(_Resource):
     """Выпадающие списки"""
+    bodies = CompressedCache()
 
     @jwt_required()
     def get(self):
-        return self.return_json(*get_lists())
+        """Справочники почти не меняются: отдаём ETag и отвечаем 304, если у клиента актуальная версия"""
+        result, status, etag = get_lists()
+        if etag in request.if_none_match:
+            response = self.return_status(304)
+        else:
+            response = self.return_json_cached(result, status, self.bodies, etag)
+
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+        return response
 
 
 class ExcelLoad(_Resource):
-    """Выгрузка данных"""
-    parser = reqparse.RequestParser(trim=True)
-    parser.add_argument('supervision_ids', type=str, required=True)
+    """Выгрузка данных.\n
+    Строки выбираются либо по фильтру (те же параметры, что у GET /supervisions), либо по явному списку supervision_ids
+    """
+    # GET: фильтр или (устаревший вариант) supervision_ids=1,2,3,4,5
+    parser = TechnicalSupervisions.parser_get.copy()
+    parser.remove_argument('limit')
+    parser.remove_argument('cursor')
+    parser.remove_argument('stream')
+    parser.add_argument('supervision_ids', type=str)
     parser.add_argument('load_type', type=str, required=True, choices=('inside', 'outside'))
 
-    @jwt_required()
-    def get(self):
-        """supervision_ids должен иметь вид supervision_ids=1,2,3,4,5"""
-        args: dict = self.parser.parse_args()
+    # POST: список id передаётся в теле запроса {"supervision_ids": [1, 2, 3], "load_type": "inside"}
+    parser_post = parser.copy()
+    parser_post.replace_argument('supervision_ids', type=int, action='append', location='json')
+
+    def parse_selection(self, args: dict) -> tuple:
+        """Возвращает (supervision_ids, фильтр): если передан список id, фильтр не используется"""
+        if not args["supervision_ids"]:
+            return None, args
+        if isinstance(args["supervision_ids"], list):
+            return args["supervision_ids"], None
+        return list(map(int, args["supervision_ids"].split(","))), None
+
+    def send_excel(self, args: dict):
         try:
-            supervision_ids = list(map(int, args["supervision_ids"].split(",")))
+            supervision_ids, my_filter = self.parse_selection(args)
         except ValueError as e:
             return self.return_json({"message": f"Ошибка! Невозможно преобразовать строку {str(e).split(' ')[-1]} в число."}, 400)
 
-        return send_file(path_or_file=excel_load(supervision_ids, args["load_type"]), download_name='Выгрузка.xlsx', as_attachment=True)
+        result, status = excel_load(args["load_type"], supervision_ids, my_filter)
+        if status != 200:
+            return self.return_json(result, status)
+
+        return send_file(path_or_file=result, download_name='Выгрузка.xlsx', as_attachment=True)
+
+    @jwt_required()
+    def get(self):
+        return self.send_excel(self.parser.parse_args())
+
+    @jwt_required()
+    def post(self):
+        return self.send_excel(self.parser_post.parse_args())
+
+
+class ExcelLoadJobs(_Resource):
+    """Запуск фоновой выгрузки данных (только POST, статус выгрузки - ExcelLoadJob)"""
+    parser_post = ExcelLoad.parser_post
+    parse_selection = ExcelLoad.parse_selection
+
+    @jwt_required()
+    def post(self):
+        """Запуск выгрузки, параметры как у ExcelLoad.post. Возвращает job_id"""
+        args: dict = self.parser_post.parse_args()
+        supervision_ids, my_filter = self.parse_selection(args)
+        return self.return_json(*start_export(get_jwt_identity(), args["load_type"], supervision_ids, my_filter))
+
+
+class ExcelLoadJob(_Resource):
+    """Статус фоновой выгрузки данных"""
+
+    @jwt_required()
+    def get(self, job_id):
+        """Статус выгрузки: queued, running, done или error и прогресс done/total"""
+        return self.return_json(*get_export_status(get_jwt_identity(), job_id))
+
+
+class ExcelLoadJobFile(_Resource):
+    """Скачивание результата фоновой выгрузки"""
+
+    @jwt_required()
+    def get(self, job_id):
+        path, status = get_export_file(get_jwt_identity(), job_id)
+        if status != 200:
+            return self.return_json(path, status)
+
+        return send_file(path_or_file=path, download_name='Выгрузка.xlsx', as_attachment=True)
 
 
 class TakeInKs(_Resource):
@@ -158,11 +364,12 @@ class TakeInKs(_Resource):
     parser = reqparse.RequestParser(trim=True)
     parser.add_argument('take_in_ks_ids', action='append', type=int)
     parser.add_argument('not_take_in_ks_ids', action='append', type=int)
+    parser.add_argument('comments', type=dict, location='json') # {"id": "комментарий"} для take_in_ks_ids
 
     @jwt_required()
     def put(self):
         args: dict = self.parser.parse_args()
-        return self.return_json(*take_in_ks(args["take_in_ks_ids"], args["not_take_in_ks_ids"]))
+        return self.return_json(*take_in_ks(args["take_in_ks_ids"], args["not_take_in_ks_ids"], args["comments"]))
     
 
 class SupervisionsCountInfo(_Resource):
@@ -176,6 +383,38 @@ class SupervisionsCountInfo(_Resource):
         return self.return_json(*supervisions_count_info(args["year"]))
 
 
+class HoursAnalytics(_Resource):
+    """Часы работ за год (или месяц) по подрядчикам, подразделениям, исполнителям или типам дней с разбивкой по месяцам"""
+    parser = reqparse.RequestParser(trim=True)
+    parser.add_argument('year', type=int, required=True)
+    parser.add_argument('month', type=int)
+    parser.add_argument('group_by', type=str, required=True, choices=GROUPS, help='Неверная группировка')
+
+    @jwt_required()
+    def get(self):
+        args: dict = self.parser.parse_args()
+        return self.return_json(*get_hours_analytics(args["year"], args["group_by"], args["month"]))
+
+
+class Health(_Resource):
+    """Состояние сервиса: доступность БД и статистика пула соединений"""
+
+    def get(self):
+        return self.return_json(*health())
+
+
+class Metrics(_Resource):
+    """Метрики в формате Prometheus. Нужен токен (cookie или заголовок Authorization: Bearer - так его передаёт Prometheus),
+    адрес клиента должен быть в API.metrics_hosts
+    """
+
+    @jwt_required(locations=["headers", "cookies"])
+    def get(self):
+        if request.remote_addr not in METRICS_HOSTS:
+            return self.return_status(403)
+        return Response(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 class Auth(_Resource):
     parser = reqparse.RequestParser(trim=True)
     parser.add_argument('login', type=str, required=True)
@@ -206,18 +445,28 @@ class Auth(_Resource):
 build = "" if API.getboolean("build") else "/api"
 
 api.add_resource(TechnicalSupervisions, f"{build}/supervisions", f"{build}/supervisions/<int:supervision_id>")
+api.add_resource(TechnicalSupervisionsBatch, f"{build}/supervisions/batch")
+api.add_resource(TechnicalSupervisionsChanges, f"{build}/supervisions/changes")
 api.add_resource(Lists, f"{build}/lists")
 api.add_resource(ExcelLoad, f"{build}/excel_load")
+api.add_resource(ExcelLoadJobs, f"{build}/excel_load/jobs")
+api.add_resource(ExcelLoadJob, f"{build}/excel_load/jobs/<string:job_id>")
+api.add_resource(ExcelLoadJobFile, f"{build}/excel_load/jobs/<string:job_id>/file")
 api.add_resource(TakeInKs, f"{build}/take_in_ks")
 api.add_resource(SupervisionsCountInfo, f"{build}/supervisions_count_info")
+api.add_resource(HoursAnalytics, f"{build}/hours_analytics")
 api.add_resource(Auth, f"{build}/auth")
+api.add_resource(Health, f"{build}/health")
+api.add_resource(Metrics, f"{build}/metrics")
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    warm_artists()
     if API.getboolean("debug"):
         app.run(host=API.get("host"),
                 port=API.getint("port"),
                 debug=API.getboolean("debug"))
     else:
-        serve(app, port=API.getint("port"))
+        serve(app, port=API.getint("port"), threads=API.getint("threads", fallback=4))
 
@@ -0,0 +1,189 @@
+"""Метрики API в формате Prometheus: задержки и количество запросов по ресурсам, SQL-запросы на каждый HTTP-запрос.
+
+Запросы дольше API.slow_request_ms пишутся в лог slow_requests вместе с самыми долгими SQL-запросами.
+Метрики хранятся в памяти процесса: при запуске через server.py каждый рабочий процесс отдаёт свои.
+"""
+import logging
+from bisect import bisect_left
+from collections import defaultdict
+from threading import Lock, local
+from time import perf_counter
+from flask import Flask, Request, Response, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from config import API
+from my_engine import pool_status
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SQL_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500)
+SLOW_REQUEST_MS = API.getint("slow_request_ms", fallback=1000)
+# сколько самых долгих SQL-запросов попадает в лог медленного запроса и сколько их вообще запоминается на запрос
+SLOW_LOG_STATEMENTS = 10
+MAX_TRACED_STATEMENTS = 200
+# /metrics требует токен (как остальные ресурсы) и дополнительно доступен только с этих адресов
+METRICS_HOSTS = {host.strip() for host in API.get("metrics_hosts", fallback="127.0.0.1,::1").split(",")}
+
+slow_log = logging.getLogger("slow_requests")
+
+
+class Histogram:
+    """Гистограмма Prometheus: накопительные счётчики по границам buckets, сумма и количество по каждому набору меток"""
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, labels: tuple, value: float):
+        counts = self.values.setdefault(labels, [0] * (len(self.buckets) + 1) + [0.0])
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self, name: str, label_names: tuple):
+        for labels, counts in sorted(self.values.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                total += count
+                yield f"{name}_bucket", label_names + ("le",), labels + (str(bound),), total
+            yield f"{name}_sum", label_names, labels, round(counts[-1], 6)
+            yield f"{name}_count", label_names, labels, total
+
+
+_lock = Lock()
+_requests = defaultdict(int)  # (endpoint, method, status) -> количество
+_errors = defaultdict(int)  # (endpoint, method) -> количество ответов 5xx и исключений
+_latency = Histogram(LATENCY_BUCKETS)  # (endpoint, method)
+_sql_per_request = Histogram(SQL_COUNT_BUCKETS)  # (endpoint,)
+_sql_queries = defaultdict(int)  # endpoint -> количество SQL-запросов, вне HTTP-запросов (фоновые выгрузки) - "background"
+_sql_seconds = defaultdict(float)
+_sql_errors = defaultdict(int)  # endpoint -> количество SQL-запросов, завершившихся ошибкой
+_current = local()
+
+
+def _endpoint() -> str:
+    """Метка ресурса текущего HTTP-запроса, вне HTTP-запросов (фоновые выгрузки) - background"""
+    return "background" if getattr(_current, "trace", None) is None else request.endpoint or "unknown"
+
+
+# Время начала хранится в контексте выполнения запроса: он свой у каждого запроса и не переживает его,
+# даже если запрос завершился ошибкой и after_cursor_execute не был вызван
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.metrics_started = perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "metrics_started", None)
+    if started is None:
+        return
+    elapsed = perf_counter() - started
+    trace = getattr(_current, "trace", None)
+    if trace is None:
+        with _lock:
+            _sql_queries["background"] += 1
+            _sql_seconds["background"] += elapsed
+        return
+
+    trace["queries"] += 1
+    trace["sql_seconds"] += elapsed
+    if len(trace["statements"]) < MAX_TRACED_STATEMENTS:
+        trace["statements"].append((elapsed, statement))
+
+
+def _handle_error(exception_context):
+    with _lock:
+        _sql_errors[_endpoint()] += 1
+
+
+def start_request():
+    _current.trace = {"started": perf_counter(), "queries": 0, "sql_seconds": 0.0, "statements": [], "status": None}
+
+
+def finish_request(request: Request, status: int):
+    trace = getattr(_current, "trace", None)
+    if trace is None:
+        return
+    _current.trace = None
+
+    elapsed = perf_counter() - trace["started"]
+    endpoint = request.endpoint or "unknown"
+    with _lock:
+        _requests[(endpoint, request.method, str(status))] += 1
+        if status >= 500:
+            _errors[(endpoint, request.method)] += 1
+        _latency.observe((endpoint, request.method), elapsed)
+        _sql_per_request.observe((endpoint,), trace["queries"])
+        _sql_queries[endpoint] += trace["queries"]
+        _sql_seconds[endpoint] += trace["sql_seconds"]
+
+    if elapsed * 1000 >= SLOW_REQUEST_MS:
+        statements = sorted(trace["statements"], key=lambda item: item[0], reverse=True)[:SLOW_LOG_STATEMENTS]
+        slow_log.warning("Медленный запрос %s %s: %d мс, статус %s, SQL: %d запросов, %.1f мс%s",
+                         request.method, request.full_path.rstrip("?"), elapsed * 1000, status, trace["queries"], trace["sql_seconds"] * 1000,
+                         "".join(f"\n  {seconds * 1000:8.1f} мс  {' '.join(statement.split())[:500]}" for seconds, statement in statements))
+
+
+def init_metrics(app: Flask):
+    """Подключает сбор метрик к приложению и ко всем движкам SQLAlchemy"""
+    event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(Engine, "handle_error", _handle_error)
+
+    @app.before_request
+    def metrics_start():
+        start_request()
+
+    @app.after_request
+    def metrics_status(response: Response):
+        trace = getattr(_current, "trace", None)
+        if trace is not None:
+            trace["status"] = response.status_code
+        return response
+
+    # teardown вызывается после отправки потокового ответа (stream_with_context), поэтому время включает его отправку
+    @app.teardown_request
+    def metrics_finish(exception):
+        trace = getattr(_current, "trace", None)
+        if trace is not None:
+            finish_request(request, trace["status"] or 500)  # статуса нет - after_request не вызывался, запрос упал с исключением
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _sample(name: str, label_names: tuple, labels: tuple, value) -> str:
+    if not label_names:
+        return f"{name} {value}"
+    pairs = ",".join(f'{key}="{_escape(item)}"' for key, item in zip(label_names, labels))
+    return f"{name}{{{pairs}}} {value}"
+
+
+def render_metrics() -> str:
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+
+    def metric(name: str, kind: str, help_text: str, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(_sample(*item) for item in samples)
+
+    with _lock:
+        metric("http_requests_total", "counter", "HTTP-запросы по ресурсу, методу и статусу",
+               [("http_requests_total", ("endpoint", "method", "status"), key, value) for key, value in sorted(_requests.items())])
+        metric("http_request_errors_total", "counter", "Ответы 5xx и необработанные исключения",
+               [("http_request_errors_total", ("endpoint", "method"), key, value) for key, value in sorted(_errors.items())])
+        metric("http_request_duration_seconds", "histogram", "Время обработки запроса",
+               list(_latency.samples("http_request_duration_seconds", ("endpoint", "method"))))
+        metric("http_request_sql_queries", "histogram", "SQL-запросов на один HTTP-запрос",
+               list(_sql_per_request.samples("http_request_sql_queries", ("endpoint",))))
+        metric("sql_queries_total", "counter", "SQL-запросы по ресурсу (background - вне HTTP-запросов)",
+               [("sql_queries_total", ("endpoint",), (key,), value) for key, value in sorted(_sql_queries.items())])
+        metric("sql_query_duration_seconds_total", "counter", "Суммарное время SQL-запросов по ресурсу",
+               [("sql_query_duration_seconds_total", ("endpoint",), (key,), round(value, 6)) for key, value in sorted(_sql_seconds.items())])
+        metric("sql_query_errors_total", "counter", "SQL-запросы, завершившиеся ошибкой, по ресурсу",
+               [("sql_query_errors_total", ("endpoint",), (key,), value) for key, value in sorted(_sql_errors.items())])
+
+    for key, value in pool_status().items():
+        metric(f"db_pool_{key}", "gauge", f"Пул соединений с БД: {key}", [(f"db_pool_{key}", (), (), value)])
+
+    return "\n".join(lines) + "\n"
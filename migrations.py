@@ -0,0 +1,98 @@
+from sqlalchemy import func, inspect
+from sqlalchemy.schema import CreateColumn
+from models import Artist, Supervision, SupervisionChangeSequence, SupervisionMonthlyStat
+from monthly_stats import rebuild_monthly_stats
+from my_engine import engine, session_scope
+from search import create_search_index, has_search_index
+
+
+def _index(table, name: str):
+    return next(index for index in table.indexes if index.name == name)
+
+
+def create_table(table):
+    """Создаёт таблицу, если её ещё нет"""
+    def migrate():
+        if inspect(engine).has_table(table.name):
+            return False
+        table.create(engine)
+        return True
+    return migrate
+
+
+def create_monthly_stats():
+    """Создаёт supervision_monthly_stats и сразу заполняет её по supervisions: в пустой таблице счётчики были бы нулевыми,
+    а после изменений тех. надзоров - отрицательными
+    """
+    if inspect(engine).has_table(SupervisionMonthlyStat.__tablename__):
+        return False
+    rebuild_monthly_stats()
+    return True
+
+
+def create_index(table, name: str):
+    """Создаёт индекс, описанный в models.py, если его ещё нет в БД"""
+    def migrate():
+        if name in {index["name"] for index in inspect(engine).get_indexes(table.name)}:
+            return False
+        _index(table, name).create(engine)
+        return True
+    return migrate
+
+
+def add_column(table, name: str):
+    """Добавляет колонку, описанную в models.py, если её ещё нет в БД"""
+    def migrate():
+        if name in {column["name"] for column in inspect(engine).get_columns(table.name)}:
+            return False
+        with engine.begin() as connection:
+            column = CreateColumn(table.c[name]).compile(dialect=connection.dialect)
+            connection.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {column}")
+        return True
+    return migrate
+
+
+def search_index():
+    """Создаёт поисковый индекс тех. надзоров (см. search.py), если его ещё нет"""
+    with engine.begin() as connection:
+        if has_search_index(connection):
+            return False
+        create_search_index(connection)
+    return True
+
+
+def merge_duplicate_artists():
+    """Объединяет исполнителей с одинаковым fio (перед созданием уникального индекса): ссылки переводятся на минимальный id"""
+    with session_scope() as session:
+        duplicates = session.query(Artist.fio, func.min(Artist.id)).group_by(Artist.fio).having(func.count(Artist.id) > 1).all()
+        for fio, artist_id in duplicates:
+            duplicate_ids = [item for item, in session.query(Artist.id).filter(Artist.fio == fio, Artist.id != artist_id).all()]
+            session.query(Supervision).filter(Supervision.artist_id.in_(duplicate_ids)).update({"artist_id": artist_id}, synchronize_session=False)
+            session.query(Artist).filter(Artist.id.in_(duplicate_ids)).delete(synchronize_session=False)
+
+    return bool(duplicates)
+
+
+# Миграции выполняются по порядку, каждая сама проверяет, нужна ли она, поэтому скрипт можно запускать повторно
+MIGRATIONS = [
+    ("create supervision_monthly_stats", create_monthly_stats),
+    ("index supervisions (is_archived, datetime_start)", create_index(Supervision.__table__, "ix_supervisions_archived_start")),
+    ("index supervisions (is_archived, status_ks_id, datetime_start)", create_index(Supervision.__table__, "ix_supervisions_archived_ks_start")),
+    ("merge duplicate artists", merge_duplicate_artists),
+    ("unique index artists (fio)", create_index(Artist.__table__, "ux_artists_fio")),
+    ("column supervisions.version", add_column(Supervision.__table__, "version")),
+    ("fulltext index supervisions (station, type_work, note, manufacturer_info)", search_index),
+    ("create supervision_change_sequence", create_table(SupervisionChangeSequence.__table__)),
+    ("column supervisions.change_seq", add_column(Supervision.__table__, "change_seq")),
+    ("index supervisions (change_seq)", create_index(Supervision.__table__, "ix_supervisions_change_seq")),
+]
+
+
+def migrate():
+    for name, migration in MIGRATIONS:
+        print(f"{name}: {'применена' if migration() else 'уже применена'}")
+
+
+if __name__ == "__main__":
+    # python3 migrations.py - применить все недостающие изменения схемы БД
+    migrate()
@@ -1,5 +1,6 @@
 # update date: 2023-04-04 12:48
-from sqlalchemy import Column, DateTime, ForeignKey, String, Text, text
+from sqlalchemy import Column, DateTime, ForeignKey, Index, String, Text, select, text
+from sqlalchemy.sql import Select
 from sqlalchemy.dialects.mysql import INTEGER, TINYINT
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
@@ -7,19 +8,70 @@ from datetime import datetime
 
 
 
+def _format_value(value):
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M')
+    return value
+
+
+def compile_row_serializer(fields: list):
+    """Генерирует функцию row -> dict для кортежей значений в порядке fields.\n
+    fields - список (ключ, нужно ли форматировать дату). Функция собирается один раз и не делает
+    ни getattr, ни циклов по колонкам - только индексацию кортежа
+    """
+    values = [f"{name!r}: _format_value(row[{index}])" if is_datetime else f"{name!r}: row[{index}]"
+              for index, (name, is_datetime) in enumerate(fields)]
+    namespace = {}
+    exec(f"def serialize(row):\n    return {{{', '.join(values)}}}\n", {"_format_value": _format_value}, namespace)
+    return namespace["serialize"]
+
+
 class AsDictMixin:
+    # колонки, которые не попадают в as_dict
+    __dict_exclude__ = ()
+    # дополнительные ключи as_dict из связанных справочников: {ключ: (relationship, колонка справочника)}
+    __dict_lookups__ = {}
+
     @declared_attr
     def __tablename__(cls):
         return cls.__name__.lower()
 
+    @classmethod
+    def dict_columns(cls) -> list:
+        return [c for c in cls.__table__.columns if c.name not in cls.__dict_exclude__]
+
+    @classmethod
+    def row_select(cls) -> Select:
+        """Core select() кортежей, которые понимает row_serializer: колонки таблицы и названия справочников (LEFT JOIN по relationship).\n
+        Собирается один раз на модель, where/order_by/limit возвращают новые копии и не меняют исходный запрос
+        """
+        if "_row_select" not in cls.__dict__:
+            source = cls.__table__
+            columns = cls.dict_columns()
+            for key, (relationship, column) in cls.__dict_lookups__.items():
+                prop = getattr(cls, relationship).property
+                source = source.outerjoin(prop.mapper.local_table, prop.primaryjoin)
+                columns.append(prop.mapper.local_table.c[column].label(key))
+            cls._row_select = select(*columns).select_from(source)
+        return cls._row_select
+
+    @classmethod
+    def row_serializer(cls):
+        """Функция кортеж -> dict, собирается один раз на модель"""
+        if "_row_serializer" not in cls.__dict__:
+            fields = [(c.name, isinstance(c.type, DateTime)) for c in cls.dict_columns()] + [(key, False) for key in cls.__dict_lookups__]
+            cls._row_serializer = compile_row_serializer(fields)
+        return cls._row_serializer
+
+    def as_row(self) -> tuple:
+        lookups = []
+        for relationship, column in self.__dict_lookups__.values():
+            item = getattr(self, relationship)
+            lookups.append(getattr(item, column) if item else None)
+        return tuple(getattr(self, c.name) for c in self.dict_columns()) + tuple(lookups)
+
     def as_dict(self):
-        result = {}
-        for c in self.__table__.columns:
-            value = getattr(self, c.name)
-            if isinstance(value, datetime):
-                value = value.strftime('%Y-%m-%d %H:%M')
-            result[c.name] = value
-        return result
+        return self.row_serializer()(self.as_row())
 
 
 Base = declarative_base(cls=AsDictMixin)
@@ -28,7 +80,10 @@ metadata = Base.metadata
 
 class Artist(Base):
     __tablename__ = 'artists'
-    __table_args__ = {'comment': 'Таблица Ф. И. О. осуществляющего технический надзор'}
+    __table_args__ = (
+        Index('ux_artists_fio', 'fio', unique=True),
+        {'comment': 'Таблица Ф. И. О. осуществляющего технический надзор'}
+    )
 
     id = Column(INTEGER, primary_key=True, comment='id')
     fio = Column(String(255), nullable=False, comment='фио')
@@ -101,16 +156,18 @@ class User(Base):
 
     access = relationship('Access')
 
-    def as_dict(self):
-        result = super().as_dict()
-        result.pop("password")
-        result["access_name"] = self.access.name
-        return result
+    __dict_exclude__ = ("password",)
+    __dict_lookups__ = {"access_name": ("access", "name")}
 
 
 class Supervision(Base):
     __tablename__ = 'supervisions'
-    __table_args__ = {'comment': 'Основная таблица технического надзора'}
+    __table_args__ = (
+        Index('ix_supervisions_archived_start', 'is_archived', 'datetime_start'),
+        Index('ix_supervisions_archived_ks_start', 'is_archived', 'status_ks_id', 'datetime_start'),
+        Index('ix_supervisions_change_seq', 'change_seq'),
+        {'comment': 'Основная таблица технического надзора'}
+    )
 
     id = Column(INTEGER, primary_key=True, comment='id записи')
     datetime_start = Column(DateTime, nullable=False, comment='Дата, время начала работ')
@@ -131,6 +188,8 @@ class Supervision(Base):
     amount = Column(INTEGER, comment='Сумма, руб.')
     status_execution_id = Column(ForeignKey('statuses_execution.id', ondelete='RESTRICT', onupdate='CASCADE'), nullable=False, index=True, server_default=text("'1'"), comment='Статус выполнения (выполнена, в работе)')
     is_archived = Column(TINYINT(1), nullable=False, server_default=text("'0'"), comment='удалена ли строка')
+    version = Column(INTEGER, nullable=False, server_default=text("'0'"), comment='Версия строки, увеличивается при каждом изменении')
+    change_seq = Column(INTEGER, nullable=False, server_default=text("'0'"), comment='Номер последнего изменения строки (supervision_change_sequence)')
 
     artist = relationship('Artist')
     contractor = relationship('Contractor')
@@ -140,14 +199,29 @@ class Supervision(Base):
     status_execution = relationship('StatusesExecution')
     status_ks = relationship('StatusesK')
 
-    def as_dict(self):
-        result = super().as_dict()
-        result["artist"] = self.artist.fio if self.artist else None
-        result["contractor"] = self.contractor.name if self.contractor else None
-        result["day_type"] = self.day_type.name if self.day_type else None
-        result["department_responsible"] = self.department_responsible.name if self.department_responsible else None
-        result["paid_status"] = self.paid_status.name if self.paid_status else None
-        result["status_execution"] = self.status_execution.name if self.status_execution else None
-        result["status_ks"] = self.status_ks.name if self.status_ks else None
-        
-        return result
+    __dict_lookups__ = {"artist": ("artist", "fio"),
+                        "contractor": ("contractor", "name"),
+                        "day_type": ("day_type", "name"),
+                        "department_responsible": ("department_responsible", "name"),
+                        "paid_status": ("paid_status", "name"),
+                        "status_execution": ("status_execution", "name"),
+                        "status_ks": ("status_ks", "name")}
+
+
+class SupervisionMonthlyStat(Base):
+    __tablename__ = 'supervision_monthly_stats'
+    __table_args__ = {'comment': 'Счётчики тех. надзоров по месяцам (всего, выполнено, учтено в КС)'}
+
+    year = Column(INTEGER, primary_key=True, autoincrement=False, comment='год')
+    month = Column(INTEGER, primary_key=True, autoincrement=False, comment='месяц')
+    all_count = Column(INTEGER, nullable=False, server_default=text("'0'"), comment='всего тех. надзоров')
+    completed = Column(INTEGER, nullable=False, server_default=text("'0'"), comment='выполнено')
+    take_in_ks = Column(INTEGER, nullable=False, server_default=text("'0'"), comment='учтено в КС')
+
+
+class SupervisionChangeSequence(Base):
+    __tablename__ = 'supervision_change_sequence'
+    __table_args__ = {'comment': 'Счётчик изменений тех. надзоров (одна строка), его значение записывается в supervisions.change_seq'}
+
+    id = Column(INTEGER, primary_key=True, autoincrement=False)
+    value = Column(INTEGER, nullable=False, server_default=text("'0'"), comment='последний выданный номер изменения')
@@ -0,0 +1,138 @@
+import sys
+from sqlalchemy import case, extract, func, insert
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.orm import Session
+from general_function import chunks
+from models import Supervision, SupervisionMonthlyStat
+from my_engine import engine, session_scope
+
+
+def _count_by_month_query(session: Session, *filters):
+    year = extract("year", Supervision.datetime_start)
+    month = extract("month", Supervision.datetime_start)
+    return session.query(year,
+                         month,
+                         func.count(Supervision.id),
+                         func.sum(case((Supervision.status_execution_id == 2, 1), else_=0)),
+                         func.sum(case((Supervision.status_ks_id == 1, 1), else_=0))) \
+                  .filter(Supervision.is_archived == 0, *filters) \
+                  .group_by(year, month)
+
+
+def count_by_month(session: Session, *filters) -> list:
+    """Живой пересчёт счётчиков по таблице supervisions.\n
+    Возвращает строки вида (год, месяц, всего, выполнено, учтено в КС) для неархивных тех. надзоров
+    """
+    return _count_by_month_query(session, *filters).all()
+
+
+def _apply_delta(session: Session, year: int, month: int, all_count: int, completed: int, take_in_ks: int):
+    """Прибавляет к счётчикам месяца переданные значения (могут быть отрицательными).
+
+    Одним запросом INSERT ... ON DUPLICATE KEY UPDATE (в SQLite - ON CONFLICT DO UPDATE) по первичному ключу (year, month):
+    строку месяца, которой ещё нет, могут одновременно добавлять несколько запросов
+    """
+    deltas = {"all_count": all_count, "completed": completed, "take_in_ks": take_in_ks}
+    values = {name: getattr(SupervisionMonthlyStat, name) + delta for name, delta in deltas.items()}
+    if session.get_bind().dialect.name == "sqlite":
+        statement = sqlite.insert(SupervisionMonthlyStat).values(year=year, month=month, **deltas) \
+                          .on_conflict_do_update(index_elements=["year", "month"], set_=values)
+    else:
+        statement = mysql.insert(SupervisionMonthlyStat).values(year=year, month=month, **deltas).on_duplicate_key_update(values)
+    session.execute(statement)
+
+
+def apply_supervisions(session: Session, supervision_ids: list, sign: int, chunk_size: int = 500) -> set:
+    """Учитывает (sign=1) или вычитает (sign=-1) тех. надзоры с переданными id в счётчиках по месяцам.\n
+    Вызывается в той же сессии, что и изменение supervisions: с sign=-1 до изменения и с sign=1 после него.
+    Возвращает месяцы (год, месяц) неархивных тех. надзоров из supervision_ids
+    """
+    if not supervision_ids:
+        return set()
+
+    session.flush()
+    deltas = {}
+    for ids in chunks(supervision_ids, chunk_size):
+        query = _count_by_month_query(session, Supervision.id.in_(ids))
+        if sign < 0:
+            # блокируем строки до их изменения, чтобы параллельный запрос не вычел их второй раз
+            query = query.with_for_update()
+
+        for year, month, all_count, completed, take_in_ks in query.all():
+            delta = deltas.setdefault((int(year), int(month)), [0, 0, 0])
+            delta[0] += sign * int(all_count)
+            delta[1] += sign * int(completed)
+            delta[2] += sign * int(take_in_ks)
+
+    for (year, month), (all_count, completed, take_in_ks) in sorted(deltas.items()):
+        _apply_delta(session, year, month, all_count, completed, take_in_ks)
+
+    return set(deltas)
+
+
+def apply_values(session: Session, rows: list) -> set:
+    """Учитывает в счётчиках новые тех. надзоры, ещё не имеющие id (например вставленные через executemany).\n
+    rows - словари с datetime_start (datetime), status_execution_id и status_ks_id. Возвращает месяцы (год, месяц) rows
+    """
+    deltas = {}
+    for row in rows:
+        delta = deltas.setdefault((row["datetime_start"].year, row["datetime_start"].month), [0, 0, 0])
+        delta[0] += 1
+        delta[1] += row["status_execution_id"] == 2
+        delta[2] += row["status_ks_id"] == 1
+
+    for (year, month), (all_count, completed, take_in_ks) in sorted(deltas.items()):
+        _apply_delta(session, year, month, all_count, completed, take_in_ks)
+
+    return set(deltas)
+
+
+def get_year_stats(session: Session, year: int) -> list:
+    return session.query(SupervisionMonthlyStat).filter(SupervisionMonthlyStat.year == year).all()
+
+
+def rebuild_monthly_stats():
+    """Полный пересчёт таблицы supervision_monthly_stats по supervisions"""
+    SupervisionMonthlyStat.__table__.create(engine, checkfirst=True)
+    with session_scope() as session:
+        session.query(SupervisionMonthlyStat).delete(synchronize_session=False)
+        session.execute(insert(SupervisionMonthlyStat).from_select(
+            ["year", "month", "all_count", "completed", "take_in_ks"], _count_by_month_query(session).statement))
+
+
+def check_monthly_stats() -> list:
+    """Сравнивает supervision_monthly_stats с живым пересчётом.\n
+    Возвращает список расхождений вида {"year", "month", "stored", "actual"}, пустой список - расхождений нет
+    """
+    with session_scope() as session:
+        actual = {(int(year), int(month)): (int(all_count), int(completed), int(take_in_ks))
+                  for year, month, all_count, completed, take_in_ks in count_by_month(session)}
+        stored = {(item.year, item.month): (item.all_count, item.completed, item.take_in_ks)
+                  for item in session.query(SupervisionMonthlyStat).all()}
+
+    mismatches = []
+    for key in sorted(actual.keys() | stored.keys()):
+        actual_counts = actual.get(key, (0, 0, 0))
+        stored_counts = stored.get(key, (0, 0, 0))
+        if actual_counts != stored_counts:
+            mismatches.append({"year": key[0], "month": key[1], "stored": stored_counts, "actual": actual_counts})
+
+    return mismatches
+
+
+if __name__ == "__main__":
+    # python3 monthly_stats.py rebuild - пересчитать таблицу с нуля
+    # python3 monthly_stats.py check - проверить таблицу на расхождения с живым пересчётом
+    command = sys.argv[1] if len(sys.argv) > 1 else "check"
+    if command == "rebuild":
+        rebuild_monthly_stats()
+        print("supervision_monthly_stats пересчитана")
+    elif command == "check":
+        mismatches = check_monthly_stats()
+        for item in mismatches:
+            print(f'{item["year"]}-{item["month"]:02d}: в таблице {item["stored"]}, фактически {item["actual"]}')
+        print("Расхождений нет" if not mismatches else f"Найдено расхождений: {len(mismatches)}")
+        sys.exit(1 if mismatches else 0)
+    else:
+        print("Неизвестная команда, используйте rebuild или check")
+        sys.exit(2)
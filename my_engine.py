@@ -1,12 +1,52 @@
 
-from config import MYSQL
-from sqlalchemy import create_engine, MetaData
+from threading import Lock
+from time import perf_counter
+from config import API, MYSQL
+from sqlalchemy import create_engine, exc, MetaData
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 from contextlib import contextmanager
 from sqlalchemy.orm import Session
 
 
-engine = create_engine(f"mysql+mysqlconnector://{MYSQL['user']}:{MYSQL['password']}@{MYSQL['host']}/{MYSQL['database']}", encoding='utf8', echo=False)
+class TimedQueuePool(QueuePool):
+    """QueuePool, который считает, сколько времени запросы ждут свободное соединение"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = Lock()
+        self.wait_count = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.timeouts = 0
+
+    def _do_get(self):
+        started = perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            wait_time = perf_counter() - started
+            with self._stats_lock:
+                self.wait_count += 1
+                self.wait_time_total += wait_time
+                self.wait_time_max = max(self.wait_time_max, wait_time)
+
+
+# По умолчанию на каждый поток waitress и каждый поток фоновой выгрузки приходится одно постоянное соединение.
+# pool_recycle должен быть меньше wait_timeout MySQL, pre_ping проверяет соединение перед выдачей из пула
+POOL_SIZE = MYSQL.getint("pool_size", fallback=API.getint("threads", fallback=4) + API.getint("export_workers", fallback=2))
+
+engine = create_engine(f"mysql+mysqlconnector://{MYSQL['user']}:{MYSQL['password']}@{MYSQL['host']}/{MYSQL['database']}", encoding='utf8', echo=False,
+                       poolclass=TimedQueuePool,
+                       pool_size=POOL_SIZE,
+                       max_overflow=MYSQL.getint("max_overflow", fallback=POOL_SIZE // 2),
+                       pool_timeout=MYSQL.getint("pool_timeout", fallback=30),
+                       pool_recycle=MYSQL.getint("pool_recycle", fallback=3600),
+                       pool_pre_ping=True)
 my_session = sessionmaker(bind=engine)
 my_metadata = MetaData(bind=engine)
 
@@ -23,3 +63,15 @@ def session_scope():
     finally:
         session.close()
 
+
+def pool_status() -> dict:
+    """Состояние пула соединений: занято/свободно/сверх лимита и время ожидания соединения"""
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        return {}
+
+    result = {"size": pool.size(), "checked_out": pool.checkedout(), "checked_in": pool.checkedin(), "overflow": pool.overflow()}
+    if isinstance(pool, TimedQueuePool):
+        result.update(wait_count=pool.wait_count, wait_time_total=round(pool.wait_time_total, 6),
+                      wait_time_max=round(pool.wait_time_max, 6), timeouts=pool.timeouts)
+    return result
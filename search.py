@@ -0,0 +1,153 @@
+"""Полнотекстовый поиск тех. надзоров по station, type_work, note и manufacturer_info (параметр q).
+
+- MySQL - FULLTEXT-индекс ft_supervisions_text, условие и релевантность - MATCH ... AGAINST (... IN BOOLEAN MODE)
+- SQLite (локальный стенд, bench_api.py) - таблица FTS5 supervisions_fts, которую поддерживают триггеры на supervisions,
+  релевантность - bm25
+
+Условие search_match сочетается с остальными фильтрами (даты, подрядчик, статусы) как обычное условие WHERE.
+Для сортировки по релевантности запрос соединяется с подвыборкой search_results (id, relevance):
+релевантность вычисляется один раз на каждый найденный тех. надзор, а не коррелированным подзапросом на строку
+
+Индекс создаётся вместе с таблицей supervisions (metadata.create_all) или миграцией (migrations.py)
+и обновляется самой БД, поэтому код записи тех. надзоров о нём не знает
+"""
+import re
+from sqlalchemy import Boolean, String, event, inspect, literal
+from sqlalchemy.exc import CompileError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+from sqlalchemy.types import TypeDecorator
+from models import Supervision
+
+SEARCH_COLUMNS = ("station", "type_work", "note", "manufacturer_info")
+FULLTEXT_INDEX = "ft_supervisions_text"
+FTS_TABLE = "supervisions_fts"
+# Слова короче MIN_TERM_LENGTH не ищутся: MySQL по умолчанию не индексирует слова короче innodb_ft_min_token_size = 3.
+# Уменьшать вместе с innodb_ft_min_token_size (после его изменения FULLTEXT-индекс нужно пересоздать)
+MIN_TERM_LENGTH = 3
+MAX_TERMS = 10
+
+_term_re = re.compile(r"[^\W_]+")
+
+
+def parse_query(q: str) -> tuple:
+    """Слова поискового запроса в нижнем регистре, без повторов.\n
+    Ищутся тех. надзоры, содержащие все слова; каждое слово ищется по началу ("светофор" находит "светофора"),
+    так как ни FULLTEXT MySQL, ни FTS5 не приводят русские слова к основе
+    """
+    terms = [term.lower() for term in _term_re.findall(q or "") if len(term) >= MIN_TERM_LENGTH]
+    return tuple(dict.fromkeys(terms))[:MAX_TERMS]
+
+
+class _SearchQuery(TypeDecorator):
+    """Параметр запроса: слова из parse_query, в строку запроса нужного синтаксиса превращаются при выполнении.
+    Поэтому SQL с поиском кэшируется движком как обычный, слова передаются значением параметра
+    """
+    impl = String
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if dialect.name == "mysql":
+            return " ".join(f"+{term}*" for term in value)
+        return " AND ".join(f'"{term}" *' for term in value)
+
+
+class search_match(FunctionElement):
+    """Условие: тех. надзор содержит все слова"""
+    type = Boolean()
+    name = "search_match"
+    inherit_cache = True
+
+    def __init__(self, terms: tuple):
+        super().__init__(literal(terms, _SearchQuery()))
+
+
+class _search_results(FunctionElement):
+    name = "search_results"
+    inherit_cache = True
+
+    def __init__(self, terms: tuple):
+        super().__init__(literal(terms, _SearchQuery()))
+
+
+def search_results(terms: tuple):
+    """Подвыборка (id, relevance) тех. надзоров, содержащих все слова, для соединения с supervisions.
+    relevance - чем больше, тем выше в выдаче
+    """
+    return _search_results(terms).table_valued("id", "relevance")
+
+
+def _mysql_match(element, compiler, **kw) -> str:
+    return f"MATCH ({', '.join(SEARCH_COLUMNS)}) AGAINST ({compiler.process(element.clauses, **kw)} IN BOOLEAN MODE)"
+
+
+@compiles(search_match, "mysql")
+def _mysql_condition(element, compiler, **kw):
+    return _mysql_match(element, compiler, **kw)
+
+
+@compiles(_search_results, "mysql")
+def _mysql_results(element, compiler, **kw):
+    match = _mysql_match(element, compiler, **kw)
+    return f"(SELECT id, {match} AS relevance FROM {Supervision.__tablename__} WHERE {match})"
+
+
+# Условие - список id из FTS5, который SQLite строит один раз на запрос; строки по-прежнему выбираются по индексу дат.
+# Соединение с подвыборкой по rowid внутри условия SQLite выполнял бы поиском FTS5 на каждую строку
+@compiles(search_match, "sqlite")
+def _sqlite_condition(element, compiler, **kw):
+    return (f"{compiler.process(Supervision.__table__.c.id, **kw)} IN "
+            f"(SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH {compiler.process(element.clauses, **kw)})")
+
+
+# "+rowid" не даёт SQLite перенести условие соединения (rowid = supervisions.id) внутрь подвыборки:
+# иначе он может перебирать строки по индексу дат и для каждой выполнять поиск FTS5 заново
+@compiles(_search_results, "sqlite")
+def _sqlite_results(element, compiler, **kw):
+    return (f"(SELECT +rowid AS id, -bm25({FTS_TABLE}) AS relevance FROM {FTS_TABLE} "
+            f"WHERE {FTS_TABLE} MATCH {compiler.process(element.clauses, **kw)})")
+
+
+@compiles(search_match)
+@compiles(_search_results)
+def _unsupported(element, compiler, **kw):
+    raise CompileError(f"Полнотекстовый поиск не поддерживается для {compiler.dialect.name}")
+
+
+def has_search_index(connection) -> bool:
+    if connection.dialect.name == "mysql":
+        return FULLTEXT_INDEX in {index["name"] for index in inspect(connection).get_indexes(Supervision.__tablename__)}
+    return inspect(connection).has_table(FTS_TABLE)
+
+
+def create_search_index(connection):
+    """Создаёт поисковый индекс по уже существующей таблице supervisions и заполняет его"""
+    columns = ", ".join(SEARCH_COLUMNS)
+    if connection.dialect.name == "mysql":
+        connection.exec_driver_sql(f"ALTER TABLE {Supervision.__tablename__} ADD FULLTEXT INDEX {FULLTEXT_INDEX} ({columns})")
+        return
+
+    new_values = ", ".join(f"new.{name}" for name in SEARCH_COLUMNS)
+    old_values = ", ".join(f"old.{name}" for name in SEARCH_COLUMNS)
+    insert_new = f"INSERT INTO {FTS_TABLE} (rowid, {columns}) VALUES (new.id, {new_values});"
+    delete_old = f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, {columns}) VALUES ('delete', old.id, {old_values});"
+    for statement in (
+        f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5({columns}, content='{Supervision.__tablename__}', content_rowid='id')",
+        f"CREATE TRIGGER {FTS_TABLE}_ai AFTER INSERT ON {Supervision.__tablename__} BEGIN {insert_new} END",
+        f"CREATE TRIGGER {FTS_TABLE}_ad AFTER DELETE ON {Supervision.__tablename__} BEGIN {delete_old} END",
+        f"CREATE TRIGGER {FTS_TABLE}_au AFTER UPDATE OF {columns} ON {Supervision.__tablename__} BEGIN {delete_old} {insert_new} END",
+        f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('rebuild')",
+    ):
+        connection.exec_driver_sql(statement)
+
+
+@event.listens_for(Supervision.__table__, "after_create")
+def _create_with_table(target, connection, **kw):
+    create_search_index(connection)
+
+
+@event.listens_for(Supervision.__table__, "before_drop")
+def _drop_with_table(target, connection, **kw):
+    # FULLTEXT-индекс MySQL и триггеры SQLite удаляются вместе с таблицей, таблица FTS5 - отдельно
+    if connection.dialect.name == "sqlite":
+        connection.exec_driver_sql(f"DROP TABLE IF EXISTS {FTS_TABLE}")
@@ -0,0 +1,161 @@
+"""Запуск API в нескольких процессах (pre-fork) на общем сокете.
+
+python3 server.py - главный процесс открывает порт и запускает workers рабочих процессов waitress по threads потоков (раздел API в settings.ini).
+- упавший рабочий процесс перезапускается
+- SIGHUP - плавный перезапуск: стартуют новые процессы (с текущим кодом и settings.ini), старые дорабатывают начатые запросы и завершаются
+- SIGTERM / SIGINT - плавная остановка
+- начатые выгрузки Excel достраиваются в пределах graceful_timeout, остальные помечаются ошибкой
+"""
+import logging
+import os
+import signal
+import socket
+import sys
+import traceback
+from importlib import reload
+from time import monotonic, sleep
+import config
+
+# Сколько секунд рабочий процесс дорабатывает начатые запросы после SIGTERM
+GRACEFUL_TIMEOUT = config.API.getint("graceful_timeout", fallback=30)
+# Процесс, упавший быстрее этого времени после старта, перезапускается с паузой, чтобы не перезапускать его в цикле
+MIN_WORKER_LIFETIME = 1
+
+
+def bind_socket(port: int) -> socket.socket:
+    """Слушающий сокет, общий для всех рабочих процессов (наследуется при fork), на всех интерфейсах, как serve(app, port=...)"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("0.0.0.0", port))
+    sock.listen(1024)
+    return sock
+
+
+def workers_count() -> int:
+    return config.API.getint("workers", fallback=os.cpu_count() or 1)
+
+
+def threads_count() -> int:
+    return config.API.getint("threads", fallback=4)
+
+
+def _is_idle(channel) -> bool:
+    """Соединение без начатого запроса и неотправленного ответа (keep-alive)"""
+    return not channel.requests and channel.request is None and not channel.total_outbufs_len
+
+
+def run_worker(sock: socket.socket):
+    """Тело рабочего процесса. Приложение импортируется уже после fork: у каждого процесса свой пул соединений с БД,
+    свои потоки выгрузок, а при плавном перезапуске подхватывается новый код
+    """
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda *_: stopping.append(monotonic()))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C получает вся группа процессов, останавливает их главный процесс
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    logging.basicConfig(level=logging.INFO, format=f"%(asctime)s [{os.getpid()}] %(name)s %(levelname)s %(message)s")
+    from waitress.channel import HTTPChannel
+    from waitress.server import create_server
+    from export_jobs import shutdown_jobs
+    from main_api import app, warm_artists
+
+    warm_artists()
+    server = create_server(app, sockets=[sock], threads=threads_count())
+    loop = server.asyncore.loop
+    while not stopping:
+        loop(timeout=1, map=server._map, use_poll=server.adj.asyncore_use_poll, count=1)
+
+    # новые соединения примут другие процессы, а этот дорабатывает начатые запросы
+    server.del_channel()
+    deadline = stopping[0] + GRACEFUL_TIMEOUT
+    while monotonic() < deadline:
+        channels = [channel for channel in list(server._map.values()) if isinstance(channel, HTTPChannel)]
+        for channel in channels:
+            if _is_idle(channel):
+                channel.handle_close()
+        if not any(channel.connected for channel in channels):
+            break
+        loop(timeout=0.1, map=server._map, use_poll=server.adj.asyncore_use_poll, count=1)
+
+    server.task_dispatcher.shutdown()
+    # потоки выгрузок завершатся вместе с процессом (os._exit), поэтому незавершённые выгрузки дожидаются или помечаются ошибкой
+    shutdown_jobs(deadline - monotonic())
+
+
+def spawn_worker(sock: socket.socket) -> int:
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            run_worker(sock)
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+
+def main():
+    sock = bind_socket(config.API.getint("port"))
+    # pid -> (поколение, время запуска). Поколение увеличивается при каждом SIGHUP, старые поколения не перезапускаются
+    workers = {}
+    generation = 0
+    events = []
+    signal.signal(signal.SIGTERM, lambda *_: events.append("stop"))
+    signal.signal(signal.SIGINT, lambda *_: events.append("stop"))
+    signal.signal(signal.SIGHUP, lambda *_: events.append("reload"))
+
+    def spawn():
+        workers[spawn_worker(sock)] = (generation, monotonic())
+
+    for _ in range(workers_count()):
+        spawn()
+    print(f"Порт {config.API.getint('port')}: {workers_count()} процессов по {threads_count()} потоков, pid {os.getpid()}", flush=True)
+
+    while "stop" not in events:
+        if "reload" in events:
+            events.remove("reload")
+            old = list(workers)
+            generation += 1
+            reload(config)  # новые процессы получат перечитанный settings.ini (порт не меняется)
+            for _ in range(workers_count()):
+                spawn()
+            for pid in old:
+                os.kill(pid, signal.SIGTERM)
+            print(f"Перезапуск: поколение {generation}", flush=True)
+
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            pid = 0
+        if pid == 0:
+            sleep(0.2)
+            continue
+
+        worker_generation, started_at = workers.pop(pid, (None, None))
+        if worker_generation == generation:
+            print(f"Процесс {pid} завершился (код {os.waitstatus_to_exitcode(status)}), запускаю новый", file=sys.stderr, flush=True)
+            if monotonic() - started_at < MIN_WORKER_LIFETIME:
+                sleep(MIN_WORKER_LIFETIME)
+            spawn()
+
+    for pid in workers:
+        os.kill(pid, signal.SIGTERM)
+    deadline = monotonic() + GRACEFUL_TIMEOUT + 5
+    while workers and monotonic() < deadline:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid:
+            workers.pop(pid, None)
+        else:
+            sleep(0.2)
+    for pid in workers:
+        os.kill(pid, signal.SIGKILL)
+    sock.close()
+
+
+if __name__ == "__main__":
+    main()
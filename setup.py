@@ -55,12 +55,24 @@ def base_configurate_project():
         config_with_global.set('API', 'port', '5000')
         config_with_global.set('API', 'debug', 'False')
         config_with_global.set('API', 'build', 'False')
+        config_with_global.set('API', 'workers', '2')
+        config_with_global.set('API', 'threads', '4')
+        config_with_global.set('API', 'graceful_timeout', '30')
+        config_with_global.set('API', 'export_workers', '2')
+        config_with_global.set('API', 'export_ttl', '600')
+        config_with_global.set('API', 'compress_min_size', '1024')
+        config_with_global.set('API', 'slow_request_ms', '1000')
+        config_with_global.set('API', 'metrics_hosts', '127.0.0.1,::1')
 
         config_with_global.add_section('MySQL')
         config_with_global.set('MySQL', 'host', 'localhost')
         config_with_global.set('MySQL', 'database', db if db else 'database')
         config_with_global.set('MySQL', 'user', user if user else 'user')
         config_with_global.set('MySQL', 'password', password if password else 'password')
+        config_with_global.set('MySQL', 'pool_size', '6')
+        config_with_global.set('MySQL', 'max_overflow', '3')
+        config_with_global.set('MySQL', 'pool_timeout', '30')
+        config_with_global.set('MySQL', 'pool_recycle', '3600')
         
         config_with_global.add_section('SECRET_KEY')
         config_with_global.set('SECRET_KEY', 'key', popen("uuidgen").read())
@@ -0,0 +1,91 @@
+"""Кэш готовых JSON-ответов get_supervisions (списки и страницы тех. надзоров) в памяти процесса.
+
+- ключ - нормализованный фильтр TechnicalSupervisions.parser_get: диапазон дат вместо date_start/date_end или year/month,
+  слова поиска вместо q, без пустых параметров
+- у каждого месяца свой счётчик поколений. Запись тех. надзоров после commit увеличивает счётчики месяцев,
+  в которых тех. надзоры были до и после изменения (invalidate). Ответ отдаётся из кэша, только если поколения
+  всех месяцев его диапазона не изменились с тех пор, как его прочитали из БД
+- записи из других процессов (server.py) счётчики не увеличивают, поэтому ответ живёт не дольше SUPERVISIONS_CACHE_TTL секунд
+- объём ограничен SUPERVISIONS_CACHE_MB на процесс, при переполнении выбрасываются давно не запрошенные ответы (LRU)
+- у записи, как у compression.CompressedCache, есть тело без сжатия (кодировка None) и сжатые варианты (gzip, br), которые
+  добавляются при первом запросе с такой кодировкой
+"""
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from threading import Lock
+from time import monotonic
+from config import API
+
+SUPERVISIONS_CACHE_TTL = API.getint("supervisions_cache_ttl", fallback=30)
+SUPERVISIONS_CACHE_MB = API.getint("supervisions_cache_mb", fallback=64)
+
+_entries = OrderedDict()  # ключ -> (поколения месяцев ответа, время чтения, {кодировка: тело ответа})
+_generations = {}  # (год, месяц) -> поколение
+_size = 0
+_lock = Lock()
+
+
+def months_between(start: datetime, end: datetime) -> tuple:
+    """Месяцы (год, месяц), которые пересекаются с полуинтервалом [start, end)"""
+    last = end - timedelta(microseconds=1)
+    year, month = start.year, start.month
+    months = []
+    while (year, month) <= (last.year, last.month):
+        months.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return tuple(months)
+
+
+def _entry_size(entry: tuple) -> int:
+    return sum(len(body) for body in entry[2].values())
+
+
+def lookup(key: tuple, months: tuple) -> tuple:
+    """Возвращает (тела ответа {кодировка: тело} или None, поколения months).
+    Поколения берутся до чтения БД и передаются в store: если месяц изменится во время чтения, ответ не будет отдан из кэша
+    """
+    with _lock:
+        generations = tuple(_generations.get(month, 0) for month in months)
+        entry = _entries.get(key)
+        if entry is not None and entry[0] == generations and monotonic() - entry[1] < SUPERVISIONS_CACHE_TTL:
+            _entries.move_to_end(key)
+            return dict(entry[2]), generations
+    return None, generations
+
+
+def store(key: tuple, generations: tuple, encoding, body: bytes):
+    """Сохраняет тело ответа в кодировке encoding. encoding = None - новый ответ из БД (заменяет запись целиком),
+    иначе сжатый вариант добавляется к записи, если она ещё соответствует generations
+    """
+    global _size
+    limit = SUPERVISIONS_CACHE_MB * 1024 * 1024
+    if len(body) > limit:
+        return
+
+    with _lock:
+        entry = _entries.get(key)
+        if encoding is None:
+            if entry is not None:
+                _size -= _entry_size(_entries.pop(key))
+            _entries[key] = (generations, monotonic(), {None: body})
+        elif entry is not None and entry[0] == generations and encoding not in entry[2]:
+            entry[2][encoding] = body
+        else:
+            return
+        _size += len(body)
+        while _size > limit:
+            _size -= _entry_size(_entries.popitem(last=False)[1])
+
+
+def invalidate(months):
+    """Увеличивает поколения месяцев. Вызывать после commit записи тех. надзоров этих месяцев"""
+    with _lock:
+        for month in months:
+            _generations[month] = _generations.get(month, 0) + 1
+
+
+def clear():
+    global _size
+    with _lock:
+        _entries.clear()
+        _size = 0
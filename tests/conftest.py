@@ -0,0 +1,23 @@
+"""config.py читает settings.ini из текущего каталога при импорте: тесты запускаются в каталоге с минимальным settings.ini"""
+import os
+import sys
+import tempfile
+
+SETTINGS = """[API]
+build = False
+threads = 4
+
+[MySQL]
+host = localhost
+database = test
+user = test
+password = test
+
+[SECRET_KEY]
+key = test
+"""
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp(prefix="supervisions_tests_"))
+with open("settings.ini", "w", encoding="utf-8") as file:
+    file.write(SETTINGS)
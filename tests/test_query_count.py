@@ -0,0 +1,60 @@
+"""Количество SQL-запросов API-функций не должно зависеть от количества тех. надзоров (нет N+1)"""
+import io
+import random
+import pytest
+from sqlalchemy import event
+import bench_api
+import functions
+import supervisions_cache
+
+
+def prepare(directory, rows: int):
+    engine = bench_api.make_engine(f"sqlite:///{directory / f'supervisions_{rows}.db'}")
+    bench_api.seed(engine, rows, random.Random(rows))
+    return engine
+
+
+def count_statements(engine, call) -> int:
+    statements = []
+    listener = lambda *args: statements.append(args[2])
+    supervisions_cache.clear()  # иначе get_supervisions ответит из кэша без запросов
+    event.listen(engine, "before_cursor_execute", listener)
+    try:
+        result = call()  # (тело, статус) или (тело, статус, кодировка)
+        assert result[1] == 200, result[0]
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+    return len(statements)
+
+
+# все тех. надзоры, которые заполняет bench_api.seed
+ALL_DATES = {"date_start": "2021-01-01", "date_end": "2023-12-31"}
+
+CALLS = {
+    "get_supervisions": lambda: functions.get_supervisions(ALL_DATES),
+    "get_supervisions page": lambda: functions.get_supervisions({**ALL_DATES, "limit": 50}),
+    "get_supervisions sorted": lambda: functions.get_supervisions({**ALL_DATES, "sort_key": "station", "sort_by": "DESC"}),
+    "get_single_supervision": lambda: functions.get_single_supervision(1),
+    "excel_load by filter": lambda: functions.excel_load("inside", my_filter=ALL_DATES, output=io.BytesIO()),
+    "excel_load by filter sorted": lambda: functions.excel_load("inside", my_filter={**ALL_DATES, "sort_key": "station", "sort_by": "ASC"}, output=io.BytesIO()),
+    "excel_load by ids": lambda: functions.excel_load("inside", supervision_ids=list(range(1, 40)), output=io.BytesIO()),
+}
+
+
+@pytest.fixture(scope="module")
+def statement_counts(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("db")
+    counts = {}
+    for rows in (40, 400):
+        engine = prepare(directory, rows)
+        for name, call in CALLS.items():
+            call()  # первый вызов заполняет кэши справочников и исполнителей
+            counts[name, rows] = count_statements(engine, call)
+        engine.dispose()
+    return counts
+
+
+@pytest.mark.parametrize("name", CALLS)
+def test_statement_count_does_not_depend_on_rows(statement_counts, name):
+    assert statement_counts[name, 40] == statement_counts[name, 400]
+    assert statement_counts[name, 40] <= 2
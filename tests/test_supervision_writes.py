@@ -0,0 +1,105 @@
+"""Записи тех. надзоров: кэш списков (supervisions_cache) и счётчики по месяцам (supervision_monthly_stats) не расходятся с БД"""
+import json
+import random
+from datetime import datetime, timedelta
+import pytest
+import bench_api
+import functions
+import monthly_stats
+import supervisions_cache
+
+MAY = {"year": 2023, "month": 5}
+JUNE = {"year": 2023, "month": 6}
+
+
+@pytest.fixture
+def database(tmp_path):
+    engine = bench_api.make_engine(f"sqlite:///{tmp_path / 'supervisions.db'}")
+    bench_api.seed(engine, 200, random.Random(200))
+    yield engine
+    supervisions_cache.clear()
+    engine.dispose()
+
+
+def month_rows(my_filter: dict) -> dict:
+    """{id: тех. надзор} месяца, как его отдаёт get_supervisions (из кэша, если ответ там есть)"""
+    body, status, encoding = functions.get_supervisions(dict(my_filter))
+    assert status == 200 and encoding is None, body
+    return {row["id"]: row for row in json.loads(body)}
+
+
+def payload(rng: random.Random) -> dict:
+    """Тех. надзор в разобранном виде (TechnicalSupervisions.parser) за апрель-июль 2023"""
+    start = datetime(2023, rng.randint(4, 7), rng.randint(1, 28), rng.randint(6, 12))
+    item = bench_api.supervision_payload(rng)
+    item.update(datetime_start=start.strftime("%Y-%m-%d %H:%M"), datetime_end=(start + timedelta(hours=8)).strftime("%Y-%m-%d %H:%M"),
+                status_ks_id=rng.randint(1, 2), status_execution_id=rng.randint(1, 3))
+    return item
+
+
+def current_version(supervision_id: int) -> int:
+    return functions.get_single_supervision(supervision_id)[0]["version"]
+
+
+def test_cached_month_reflects_patch(database):
+    row = next(iter(month_rows(MAY).values()))
+    body = functions.get_supervisions(dict(MAY))[0]
+    assert functions.get_supervisions(dict(MAY))[0] is body  # без записей ответ отдаётся из кэша
+
+    assert functions.patch_supervision(row["id"], row["version"], {"note": "изменено"}) == ({"version": row["version"] + 1}, 200)
+    assert month_rows(MAY)[row["id"]]["note"] == "изменено"
+
+
+def test_moved_supervision_leaves_old_month_and_appears_in_new(database):
+    may, june = month_rows(MAY), month_rows(JUNE)
+    row = next(iter(may.values()))
+
+    status = functions.patch_supervision(row["id"], row["version"], {"datetime_start": "2023-06-15 08:00", "datetime_end": "2023-06-15 16:00"})[1]
+    assert status == 200
+    assert month_rows(MAY).keys() == may.keys() - {row["id"]}
+    assert month_rows(JUNE).keys() == june.keys() | {row["id"]}
+    assert monthly_stats.check_monthly_stats() == []
+
+
+def test_random_writes_keep_counters_and_cache_consistent(database):
+    rng = random.Random(2023)
+    months = [{"year": 2023, "month": month} for month in range(4, 8)]
+    for _ in range(60):
+        for my_filter in months:
+            month_rows(my_filter)  # ответы всех месяцев в кэше перед каждой записью
+
+        supervision_id = rng.randint(1, 200)
+        operation = rng.choice(("add", "batch", "put", "patch", "delete", "take_in_ks"))
+        if operation == "add":
+            result = functions.add_supervision(payload(rng))
+        elif operation == "batch":
+            result = functions.add_supervisions([payload(rng) for _ in range(rng.randint(1, 5))], [])
+        elif operation == "put":
+            result = functions.change_supervision(supervision_id, payload(rng))
+        elif operation == "patch":
+            item = payload(rng)
+            fields = {key: item[key] for key in rng.sample(["datetime_start", "status_ks_id", "status_execution_id", "note"], 2)}
+            if "datetime_start" in fields:
+                fields["datetime_end"] = item["datetime_end"]
+            result = functions.patch_supervision(supervision_id, current_version(supervision_id), fields)
+        elif operation == "delete":
+            result = functions.delete_supervision(supervision_id)
+        else:
+            result = functions.take_in_ks(rng.sample(range(1, 201), 10), rng.sample(range(1, 201), 10))
+        assert result[1] == 200, (operation, result)
+
+    assert monthly_stats.check_monthly_stats() == []
+    cached = [month_rows(my_filter) for my_filter in months]
+    supervisions_cache.clear()
+    assert cached == [month_rows(my_filter) for my_filter in months]
+
+
+def test_stale_version_is_rejected(database):
+    row = next(iter(month_rows(MAY).values()))
+    assert functions.patch_supervision(row["id"], row["version"], {"note": "первое"})[1] == 200
+
+    for fields in ({"note": "второе"}, {}):
+        body, status = functions.patch_supervision(row["id"], row["version"], fields)
+        assert status == 409
+        assert body["version"] == row["version"] + 1
+    assert month_rows(MAY)[row["id"]]["note"] == "первое"